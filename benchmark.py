@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# coding=UTF-8
+#
+# Copyright (c) 2014 Mathias Panzenböck
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import with_statement, division, print_function
+
+import os
+import sys
+import stat
+import json
+import random
+import shutil
+import tempfile
+
+from itertools import islice
+
+import fezpak
+
+try:
+	from time import perf_counter as clock
+except ImportError:
+	from time import time as clock
+
+# roughly what fits into the kernel's 4 KiB readdir buffer
+READDIR_CHUNK = 128
+
+# what the kernel asks for per read with the default mount options
+FUSE_READ_SIZE = 2 ** 17
+
+# magics of the file types that can be detected by their first bytes
+MAGICS = [m.magic for ext, matchers in fezpak.FILE_TYPES for m in matchers if m.offset == 0 and m.mask is None]
+
+SIZE_DISTRIBUTIONS = ('fixed', 'uniform', 'exp')
+
+def make_flat_archive(path,count):
+	buffers = [("file%06d" % i, b'') for i in range(count)]
+	with open(path,"wb") as stream:
+		fezpak.pack_buffers(stream,buffers)
+
+def entry_size(rnd,dist,size,max_size):
+	if dist == 'fixed':
+		return size
+	elif dist == 'uniform':
+		return rnd.randint(0, 2 * size)
+	elif dist == 'exp':
+		return min(int(rnd.expovariate(1 / size)), max_size) if size > 0 else 0
+	else:
+		raise ValueError('unknown size distribution: %s' % dist)
+
+def entry_name(i,depth,fanout):
+	parts = []
+	n = i
+	for level in range(depth):
+		parts.append("d%d" % (n % fanout))
+		n //= fanout
+	parts.append("file%06d" % i)
+	return os.path.join(*parts)
+
+# Writes an archive of count entries with random content. Sizes follow
+# dist around size, names are spread over depth levels of fanout
+# directories and dup_ratio of the entries repeat the content of an
+# earlier entry. Data is sliced out of one random blob, so big archives
+# are generated with little memory.
+def make_archive(path,count,size=1024,dist='exp',depth=2,fanout=16,dup_ratio=0.0,seed=0):
+	rnd = random.Random(seed)
+	max_size = 2 * size if dist != 'exp' else 8 * size
+	blob = memoryview(bytearray(rnd.getrandbits(8) for i in range(max_size + 1)))
+
+	contents = []
+	with open(path,"wb") as stream:
+		with fezpak.PakWriter(stream) as writer:
+			for i in range(count):
+				if contents and rnd.random() < dup_ratio:
+					content = contents[rnd.randrange(len(contents))]
+				else:
+					data_size = entry_size(rnd,dist,size,max_size)
+					magic = rnd.choice(MAGICS)[:data_size]
+					offset = rnd.randint(0, max_size - data_size + len(magic))
+					content = (magic, offset, data_size - len(magic))
+					contents.append(content)
+
+				magic, offset, data_size = content
+				writer.add(entry_name(i,depth,fanout),[magic, blob[offset:offset + data_size]],len(magic) + data_size)
+
+class NullOutput(object):
+	def write(self,data):
+		pass
+
+	def flush(self):
+		pass
+
+def make_operations(archive,tree):
+	if tree == 'compact':
+		return fezpak.CompactOperations(archive)
+	else:
+		return fezpak.Operations(archive,lazy=tree == 'lazy')
+
+def synthetic_archive(tmpdir,args):
+	path = os.path.join(tmpdir,"synthetic.pak")
+	if not os.path.exists(path):
+		make_archive(path,args.entries,args.size,args.size_dist,args.depth,args.fanout,args.dup_ratio,args.seed)
+	return path
+
+def unpacked_archive(tmpdir,args):
+	outdir = os.path.join(tmpdir,"unpacked")
+	if not os.path.exists(outdir):
+		with open(synthetic_archive(tmpdir,args),"rb") as stream:
+			fezpak.unpack(stream,outdir)
+	return outdir
+
+def fresh_dir(tmpdir,name):
+	path = os.path.join(tmpdir,name)
+	if os.path.exists(path):
+		shutil.rmtree(path)
+	return path
+
+# Every benchmark gets a setup function that prepares its input and returns
+# a function that runs the timed operation once and returns the number of
+# processed entries.
+
+def bench_index(tmpdir,args):
+	path = synthetic_archive(tmpdir,args)
+	def run():
+		with open(path,"rb") as stream:
+			return len(fezpak.load_index(stream))
+	return run
+
+def bench_list(tmpdir,args):
+	path = synthetic_archive(tmpdir,args)
+	def run():
+		with open(path,"rb") as stream:
+			index = fezpak.load_index(stream)
+			fezpak.print_list(stream,details=True,out=NullOutput(),index=index)
+			return len(index)
+	return run
+
+def bench_pack(tmpdir,args):
+	indir = unpacked_archive(tmpdir,args)
+	path  = os.path.join(tmpdir,"packed.pak")
+	def run():
+		files = fezpak.list_files([indir])
+		with open(path,"wb") as stream:
+			fezpak.pack_files(stream,files,jobs=args.jobs)
+		return len(files)
+	return run
+
+def bench_unpack(tmpdir,args):
+	path = synthetic_archive(tmpdir,args)
+	def run():
+		outdir = fresh_dir(tmpdir,"unpack")
+		with open(path,"rb") as stream:
+			index = fezpak.load_index(stream)
+			fezpak.unpack(stream,outdir,index=index,jobs=args.jobs)
+		return len(index)
+	return run
+
+def bench_unpack_selected(tmpdir,args):
+	path = synthetic_archive(tmpdir,args)
+	# one top level directory, i.e. about 1/fanout of the entries
+	selected = set(["d0"]) if args.depth > 0 else set([entry_name(0,0,args.fanout)])
+	def run():
+		outdir = fresh_dir(tmpdir,"unpack_selected")
+		with open(path,"rb") as stream:
+			index = fezpak.load_index(stream)
+			count = len(fezpak.select_entries(index,selected))
+			fezpak.unpack_files(stream,selected,outdir,index=index,jobs=args.jobs)
+		return count
+	return run
+
+def bench_guess_extension(tmpdir,args):
+	path = synthetic_archive(tmpdir,args)
+	with open(path,"rb") as stream:
+		index = fezpak.load_index(stream)
+	def run():
+		with open(path,"rb") as stream:
+			return len(fezpak.guess_extensions(stream,index))
+	return run
+
+# Emulates "ls -f" on a directory: the kernel reads the listing in chunks
+# and resumes each chunk at the offset returned with the last entry.
+def bench_readdir(tmpdir,args):
+	path = os.path.join(tmpdir,"flat.pak")
+	if not os.path.exists(path):
+		make_flat_archive(path,args.entries)
+
+	def run():
+		with open(path,"rb") as archive:
+			ops = make_operations(archive,args.tree)
+			fh = ops.opendir(fezpak.llfuse.ROOT_INODE,None)
+
+			offset = 0
+			count  = 0
+			while True:
+				chunk = list(islice(ops.readdir(fh,offset),args.chunk))
+				if not chunk:
+					break
+				offset = chunk[-1][2]
+				count += len(chunk)
+		return count
+	return run
+
+def walk_operations(ops,inode):
+	count = 0
+	fh = ops.opendir(inode,None)
+	for name, attrs, offset in list(ops.readdir(fh,0)):
+		attrs = ops.lookup(inode,name,None)
+		if stat.S_ISDIR(attrs.st_mode):
+			count += walk_operations(ops,attrs.st_ino)
+		else:
+			fh = ops.open(attrs.st_ino,os.O_RDONLY,None)
+			for pos in range(0,attrs.st_size,FUSE_READ_SIZE):
+				ops.read(fh,pos,FUSE_READ_SIZE)
+			ops.release(fh)
+			count += 1
+	return count
+
+# Walks the whole tree like "find -type f -exec cat" would, calling the
+# Operations methods directly (no mount needed). This includes building
+# the tree.
+def bench_fuse(tmpdir,args):
+	path = synthetic_archive(tmpdir,args)
+	def run():
+		with open(path,"rb") as archive:
+			with fezpak.llfuse.lock:
+				ops = make_operations(archive,args.tree)
+				return walk_operations(ops,fezpak.llfuse.ROOT_INODE)
+	return run
+
+BENCHMARKS = {
+	'index':          bench_index,
+	'list':           bench_list,
+	'pack':           bench_pack,
+	'unpack':         bench_unpack,
+	'unpack_selected': bench_unpack_selected,
+	'guess_extension': bench_guess_extension,
+	'readdir':        bench_readdir,
+	'fuse':           bench_fuse
+}
+
+FUSE_BENCHMARKS = set(['readdir', 'fuse'])
+
+def run_benchmark(tmpdir,name,args):
+	run = BENCHMARKS[name](tmpdir,args)
+	times = []
+	for i in range(args.repeat):
+		start = clock()
+		count = run()
+		times.append(clock() - start)
+	return {'entries': count, 'seconds': min(times), 'times': times}
+
+# Compares results to a baseline. Returns the names of the benchmarks that
+# got slower by more than threshold (a ratio).
+def compare(results,baseline,threshold,out=sys.stdout):
+	regressions = []
+	for name in sorted(results):
+		base = baseline.get('results',{}).get(name)
+		if base is None:
+			continue
+		ratio = results[name]['seconds'] / base['seconds'] if base['seconds'] > 0 else 1.0
+		if ratio > threshold:
+			regressions.append(name)
+			mark = ' SLOWER'
+		elif ratio < 1 / threshold:
+			mark = ' faster'
+		else:
+			mark = ''
+		out.write("%-16s %10.3f s -> %10.3f s  %6.2fx%s\n" % (name, base['seconds'], results[name]['seconds'], ratio, mark))
+	return regressions
+
+def main(argv):
+	import argparse
+
+	parser = argparse.ArgumentParser(description='benchmark fezpak operations')
+	parser.add_argument('-n','--entries',type=int,default=100000,
+		help='number of entries in the synthetic archive (default: 100000)')
+	parser.add_argument('-s','--size',type=int,default=1024,
+		help='mean entry size in bytes (default: 1024)')
+	parser.add_argument('--size-dist',choices=SIZE_DISTRIBUTIONS,default='exp',
+		help='distribution of the entry sizes (default: exp)')
+	parser.add_argument('--depth',type=int,default=2,
+		help='directory levels above the files (default: 2)')
+	parser.add_argument('--fanout',type=int,default=16,
+		help='sub-directories per directory (default: 16)')
+	parser.add_argument('--dup-ratio',type=float,default=0.0,metavar='RATIO',
+		help='fraction of entries that duplicate the content of another entry (default: 0)')
+	parser.add_argument('--seed',type=int,default=0,
+		help='random seed for the synthetic archive (default: 0)')
+	parser.add_argument('-j','--jobs',type=int,default=1,metavar='N',
+		help='threads used by pack and unpack (default: 1)')
+	parser.add_argument('-r','--repeat',type=int,default=3,metavar='N',
+		help='run every benchmark N times and report the fastest run (default: 3)')
+	parser.add_argument('--chunk',type=int,default=READDIR_CHUNK,
+		help='directory entries per readdir call (default: %d)' % READDIR_CHUNK)
+	parser.add_argument('--tree',choices=('eager','lazy','compact'),default='eager',
+		help='inode store used for FUSE benchmarks (default: eager)')
+	parser.add_argument('-o','--output',metavar='FILE',default=None,
+		help='write the results as JSON to FILE (- for stdout)')
+	parser.add_argument('-b','--baseline',metavar='FILE',default=None,
+		help='compare the results to a JSON file written with --output')
+	parser.add_argument('-t','--threshold',type=float,default=1.1,metavar='RATIO',
+		help='slowdown against the baseline that counts as a regression (default: 1.1)')
+	parser.add_argument('benchmarks',metavar='benchmark',nargs='*',
+		help='benchmarks to run: %s (default: all)' % ', '.join(sorted(BENCHMARKS)))
+
+	args = parser.parse_args(argv)
+
+	names = args.benchmarks or sorted(BENCHMARKS)
+	for name in names:
+		if name not in BENCHMARKS:
+			raise ValueError('unknown benchmark: %s' % name)
+
+	if not fezpak.HAS_LLFUSE:
+		if args.benchmarks and FUSE_BENCHMARKS.intersection(args.benchmarks):
+			raise ValueError('the llfuse python module is needed for the %s benchmark(s)' % ', '.join(sorted(FUSE_BENCHMARKS.intersection(args.benchmarks))))
+		names = [name for name in names if name not in FUSE_BENCHMARKS]
+
+	baseline = None
+	if args.baseline is not None:
+		with open(args.baseline) as fp:
+			baseline = json.load(fp)
+
+	# the JSON goes to stdout, so the progress has to go somewhere else
+	log = sys.stderr if args.output == '-' else sys.stdout
+
+	results = {}
+	tmpdir = tempfile.mkdtemp(prefix='fezpak-bench-')
+	try:
+		for name in names:
+			result = results[name] = run_benchmark(tmpdir,name,args)
+			log.write("%-16s %8d entries %10.3f s\n" % (name, result['entries'], result['seconds']))
+	finally:
+		shutil.rmtree(tmpdir)
+
+	report = {
+		'params': {
+			'entries':   args.entries,
+			'size':      args.size,
+			'size_dist': args.size_dist,
+			'depth':     args.depth,
+			'fanout':    args.fanout,
+			'dup_ratio': args.dup_ratio,
+			'seed':      args.seed,
+			'jobs':      args.jobs,
+			'repeat':    args.repeat,
+			'tree':      args.tree,
+			'python':    sys.version.split()[0]
+		},
+		'results': results
+	}
+
+	if args.output == '-':
+		json.dump(report,sys.stdout,indent=2,sort_keys=True)
+		sys.stdout.write("\n")
+	elif args.output is not None:
+		with open(args.output,"w") as fp:
+			json.dump(report,fp,indent=2,sort_keys=True)
+			fp.write("\n")
+
+	if baseline is not None:
+		params = dict((key, value) for key, value in report['params'].items() if key not in ('repeat', 'python'))
+		if any(baseline.get('params',{}).get(key) != value for key, value in params.items()):
+			sys.stderr.write("Warning: baseline was measured with different parameters\n")
+		regressions = compare(results,baseline,args.threshold,log)
+		if regressions:
+			raise ValueError('slower than baseline: %s' % ', '.join(regressions))
+
+if __name__ == '__main__':
+	try:
+		main(sys.argv[1:])
+	except Exception as exc:
+		sys.stderr.write("%s\n" % exc)
+		sys.exit(1)
@@ -25,7 +25,15 @@ from __future__ import with_statement, division, print_function
 
 import os
 import sys
+import errno
 import struct
+import mmap
+import io
+import select
+
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import islice
 
 try:
 	import llfuse
@@ -35,12 +43,20 @@ else:
 	HAS_LLFUSE = True
 
 HAS_STAT_NS = hasattr(os.stat_result, 'st_atime_ns')
+HAS_PREAD   = hasattr(os, 'pread')
+HAS_PWRITE  = hasattr(os, 'pwrite')
+
+try:
+	from time import perf_counter as clock
+except ImportError:
+	from time import time as clock
 
 if sys.version_info.major == 2:
 	from itertools import izip
 	def zip_bytes(*seqs):
 		return izip(*tuple((ord(x) for x in seq) for seq in seqs))
 else:
+	izip = zip
 	zip_bytes = zip
 
 def matcher(magic,offset=0,mask=None):
@@ -113,8 +129,165 @@ FILE_TYPES = [
 
 MAX_MAGIC_SIZE = max(max(m.size for m in matchers) for ext, matchers in FILE_TYPES)
 
+if hasattr(int, 'from_bytes'):
+	def bytes_to_int(data):
+		return int.from_bytes(data, 'big')
+else:
+	from binascii import hexlify
+	def bytes_to_int(data):
+		return int(hexlify(data), 16) if data else 0
+
+# Compiles the matchers of file_types into a table that is indexed by the
+# first byte of the data and lists only the matchers that can match that
+# byte (in their original order). Masked comparisons are done on integers.
+def compile_file_types(file_types,default='.bin'):
+	tests = []
+	for ext, matchers in file_types:
+		for m in matchers:
+			magic = bytearray(m.magic)
+			mask  = bytearray(m.mask) if m.mask is not None else None
+			end   = m.offset + len(magic)
+			if mask is None:
+				test = (ext, m.offset, end, m.magic, None, None)
+			else:
+				test = (ext, m.offset, end, bytes_to_int(m.magic), bytes_to_int(m.mask), len(magic))
+
+			if m.offset != 0 or not magic:
+				first_bytes = range(256)
+			elif mask is None:
+				first_bytes = (magic[0],)
+			else:
+				first_bytes = [b for b in range(256) if b & mask[0] == magic[0] & mask[0]]
+			tests.append((test, set(first_bytes)))
+
+	dispatch = tuple(tuple(test for test, first_bytes in tests if b in first_bytes) for b in range(256))
+
+	def detect(data):
+		if not data:
+			return default
+
+		for ext, offset, end, magic, mask, size in dispatch[bytearray(data[:1])[0]]:
+			if mask is None:
+				if data[offset:end] == magic:
+					return ext
+			else:
+				chunk = data[offset:end]
+				if len(chunk) < size:
+					# like the matcher only the available bytes are compared
+					shift = 8 * (size - len(chunk))
+					if bytes_to_int(chunk) & (mask >> shift) == magic >> shift:
+						return ext
+				elif bytes_to_int(chunk) & mask == magic:
+					return ext
+		return default
+
+	return detect
+
+# Instrumentation is off unless enable_stats() installed a Stats object.
+# Instrumented code only checks STATS, so the overhead is one global lookup.
+STATS = None
+
+class Stats(object):
+	__slots__ = 'counters','timers','hook','lock'
+
+	def __init__(self,hook=None):
+		import threading
+		self.counters = {}
+		# name -> [calls, seconds]
+		self.timers   = {}
+		# called as hook('count', name, value) and hook('time', name, seconds)
+		self.hook     = hook
+		self.lock     = threading.Lock()
+
+	def count(self,name,value=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name,0) + value
+		if self.hook is not None:
+			self.hook('count',name,value)
+
+	def add_time(self,name,seconds):
+		with self.lock:
+			timer = self.timers.get(name)
+			if timer is None:
+				self.timers[name] = [1, seconds]
+			else:
+				timer[0] += 1
+				timer[1] += seconds
+		if self.hook is not None:
+			self.hook('time',name,seconds)
+
+	def report(self,out=sys.stderr):
+		with self.lock:
+			timers   = sorted(self.timers.items())
+			counters = sorted(self.counters.items())
+
+		if timers:
+			out.write("%-28s %10s %12s\n" % ("phase", "calls", "seconds"))
+			for name, (calls, seconds) in timers:
+				out.write("%-28s %10d %12.6f\n" % (name, calls, seconds))
+
+		if counters:
+			out.write("%-28s %23s\n" % ("counter", "value"))
+			for name, value in counters:
+				out.write("%-28s %23d\n" % (name, value))
+
+class _Phase(object):
+	__slots__ = 'stats','name','start'
+
+	def __init__(self,stats,name):
+		self.stats = stats
+		self.name  = name
+		self.start = None
+
+	def __enter__(self):
+		self.start = clock()
+		return self
+
+	def __exit__(self,exc_type,exc_value,traceback):
+		self.stats.add_time(self.name,clock() - self.start)
+
+class _NoPhase(object):
+	__slots__ = ()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,exc_type,exc_value,traceback):
+		pass
+
+NO_PHASE = _NoPhase()
+
+# Returns a context manager that adds the time spent in it to the named timer.
+def stats_phase(name):
+	stats = STATS
+	return NO_PHASE if stats is None else _Phase(stats,name)
+
+def stats_count(name,value=1):
+	stats = STATS
+	if stats is not None:
+		stats.count(name,value)
+
+def enable_stats(hook=None):
+	global STATS
+	STATS = Stats(hook)
+	return STATS
+
+# Returns the Stats object that was active, if any.
+def disable_stats():
+	global STATS
+	stats = STATS
+	STATS = None
+	return stats
+
 # for Python < 3.3 and Windows
 def highlevel_sendfile(outfile,infile,offset,size):
+	stats = STATS
+	if stats is not None:
+		chunks = -(-size // 2 ** 20)
+		stats.count('bytes.highlevel_sendfile',size)
+		stats.count('syscalls.read',chunks)
+		stats.count('syscalls.write',chunks)
+
 	infile.seek(offset,0)
 	while size > 0:
 		if size > 2 ** 20:
@@ -128,103 +301,1134 @@ def highlevel_sendfile(outfile,infile,offset,size):
 			raise IOError("unexpected end of file")
 
 if hasattr(os, 'sendfile'):
-	def sendfile(outfile,infile,offset,size):
+	# timeout: seconds to wait for a non-blocking output to become writable,
+	# None waits forever. Raises socket.timeout when it expires.
+	def sendfile(outfile,infile,offset,size,timeout=None):
 		try:
 			out_fd = outfile.fileno()
 			in_fd  = infile.fileno()
 		except:
+			stats_count('fallbacks.sendfile')
 			highlevel_sendfile(outfile,infile,offset,size)
 		else:
 			# size == 0 has special meaning for some sendfile implentations
 			if size > 0:
-				os.sendfile(out_fd, in_fd, offset, size)
+				# data written through the file object must hit the fd first
+				outfile.flush()
+				total = size
+				calls = 0
+				while size > 0:
+					calls += 1
+					try:
+						count = os.sendfile(out_fd, in_fd, offset, size)
+					except OSError as exc:
+						if exc.errno != errno.EAGAIN:
+							raise
+						# non-blocking output, e.g. a socket with a timeout
+						if not select.select((), (out_fd,), (), timeout)[1]:
+							import socket
+							raise socket.timeout("timed out")
+						continue
+					if count == 0:
+						raise IOError("unexpected end of file")
+					offset += count
+					size   -= count
+
+				stats = STATS
+				if stats is not None:
+					stats.count('syscalls.sendfile',calls)
+					stats.count('bytes.sendfile',total)
 else:
 	sendfile = highlevel_sendfile
 
-def read_index(stream):
-	filecount = stream.read(4) # unknown header data
-	if len(filecount) < 4:
+# copy_file_range() lets the file system share or clone the data
+if hasattr(os, 'copy_file_range'):
+	def copy_range(outfile,infile,offset,size):
+		try:
+			out_fd = outfile.fileno()
+			in_fd  = infile.fileno()
+		except:
+			stats_count('fallbacks.copy_file_range')
+			highlevel_sendfile(outfile,infile,offset,size)
+			return
+
+		outfile.flush()
+		total = size
+		calls = 0
+		while size > 0:
+			calls += 1
+			try:
+				count = os.copy_file_range(in_fd, out_fd, size, offset)
+			except OSError as exc:
+				if exc.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+					raise
+				stats_count('fallbacks.copy_file_range')
+				sendfile(outfile,infile,offset,size)
+				total -= size
+				break
+
+			if count == 0:
+				raise IOError("unexpected end of file")
+			offset += count
+			size   -= count
+
+		stats = STATS
+		if stats is not None:
+			stats.count('syscalls.copy_file_range',calls)
+			stats.count('bytes.copy_file_range',total)
+else:
+	copy_range = sendfile
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+def link_file(src,dst,mode="hardlink"):
+	if mode == "hardlink":
+		try:
+			if os.path.lexists(dst):
+				os.remove(dst)
+			os.link(src,dst)
+		except OSError:
+			pass
+		else:
+			return True
+
+	elif mode != "reflink":
+		raise ValueError("unknown link mode: %s" % mode)
+
+	with open(src,"rb") as infile, open(dst,"wb") as outfile:
+		try:
+			import fcntl
+			fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+		except (ImportError, IOError, OSError):
+			size = os.fstat(infile.fileno()).st_size
+			copy_range(outfile,infile,0,size)
+			return False
+		else:
+			return True
+
+HEADER_STRUCT  = struct.Struct("<I")
+NAMELEN_STRUCT = struct.Struct("B")
+SIZE_STRUCT    = struct.Struct("<I")
+
+# name length byte + longest possible name + file size
+MAX_ENTRY_HEADER_SIZE = 1 + 255 + 4
+INDEX_WINDOW_SIZE     = 2 ** 20
+
+try:
+	array('Q')
+except ValueError:
+	# Python 2 has no 'Q' typecode, but 'L' is 64 bit on 64 bit Linux
+	OFFSET_TYPECODE = 'L'
+else:
+	OFFSET_TYPECODE = 'Q'
+
+ORDER_TYPECODE = 'I'
+
+class Index(object):
+	__slots__ = 'names','offsets','sizes','exts','order'
+
+	def __init__(self,names=None,offsets=None,sizes=None,exts=None,order=None):
+		self.names   = names   if names   is not None else []
+		self.offsets = offsets if offsets is not None else array(OFFSET_TYPECODE)
+		self.sizes   = sizes   if sizes   is not None else array(OFFSET_TYPECODE)
+		# guessed file name extensions, if known
+		self.exts    = exts
+		# positions of the entries sorted by name, if known
+		self.order   = order
+
+	def append(self,name,offset,size):
+		self.names.append(name)
+		self.offsets.append(offset)
+		self.sizes.append(size)
+		self.order = None
+
+	def __len__(self):
+		return len(self.names)
+
+	def __iter__(self):
+		return izip(self.names,self.offsets,self.sizes)
+
+	def __getitem__(self,i):
+		return self.names[i], self.offsets[i], self.sizes[i]
+
+	def __repr__(self):
+		return 'Index(%r)' % list(self)
+
+def as_index(index):
+	if isinstance(index, Index):
+		return index
+	entries = list(index)
+	return Index([entry[0] for entry in entries],
+	             array(OFFSET_TYPECODE, [entry[1] for entry in entries]),
+	             array(OFFSET_TYPECODE, [entry[2] for entry in entries]))
+
+def _map_archive(stream):
+	try:
+		fileno = stream.fileno()
+	except (AttributeError, IOError, OSError, ValueError):
+		return None
+
+	try:
+		return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+	except (IOError, OSError, ValueError):
+		# empty files, pipes etc.
+		return None
+
+if sys.version_info.major == 2:
+	def mem_view(mem,offset,size):
+		return buffer(mem,offset,size)
+else:
+	def mem_view(mem,offset,size):
+		return memoryview(mem)[offset:offset + size]
+
+def hash_member(stream,offset,size,mem=None,hash_name='sha256'):
+	import hashlib
+	if mem is not None:
+		# hashlib releases the GIL while hashing big buffers
+		return hashlib.new(hash_name, mem_view(mem,offset,size)).digest()
+
+	hasher = hashlib.new(hash_name)
+	hash_range(hasher,stream,offset,size)
+	return hasher.digest()
+
+# Feeds size bytes at offset into hasher. Moves the file position of stream.
+def hash_range(hasher,stream,offset,size,mem=None):
+	if mem is not None:
+		hasher.update(mem_view(mem,offset,size))
+		return
+
+	stream.seek(offset, 0)
+	while size > 0:
+		data = stream.read(min(size, 2 ** 20))
+		if not data:
+			raise IOError("unexpected end of file")
+		hasher.update(data)
+		size -= len(data)
+
+def load_index(stream):
+	with stats_phase('read_index'):
+		mem = _map_archive(stream)
+		if mem is not None:
+			try:
+				index = _parse_index(None,mem)
+			finally:
+				mem.close()
+		else:
+			index = _parse_index(stream,None)
+
+	stats_count('index.entries',len(index))
+	return index
+
+def _parse_index(stream,mem):
+	if mem is not None:
+		buf     = mem
+		end     = buf_end = len(mem)
+	else:
+		stream.seek(0, 2)
+		end = stream.tell()
+		stream.seek(0, 0)
+		buf     = stream.read(INDEX_WINDOW_SIZE)
+		buf_end = len(buf)
+
+	if buf_end < 4:
 		raise IOError("unexpected end of file while reading number of files")
-	
-	filecount, = struct.unpack("<I",filecount)
+
+	filecount, = HEADER_STRUCT.unpack_from(buf, 0)
+
+	unpack_namelen = NAMELEN_STRUCT.unpack_from
+	unpack_size    = SIZE_STRUCT.unpack_from
+	replace_sep    = os.path.sep != "\\"
+	sep            = os.path.sep
+	names   = []
+	offsets = array(OFFSET_TYPECODE)
+	sizes   = array(OFFSET_TYPECODE)
+	base    = 0
+	pos     = 4
+	window  = INDEX_WINDOW_SIZE
 	i = 0
 	while i < filecount:
-		namelen = stream.read(1)
-		if not namelen:
+		if pos + MAX_ENTRY_HEADER_SIZE > buf_end and buf_end < end:
+			# Read a new window starting at the next entry header. Big members
+			# are skipped and shrink the window to a single header, so the
+			# data of big members isn't read. Densely packed headers grow it.
+			if pos - buf_end > window:
+				window = MAX_ENTRY_HEADER_SIZE
+			else:
+				window = min(window * 2, INDEX_WINDOW_SIZE)
+			stream.seek(pos, 0)
+			buf     = stream.read(window)
+			base    = pos
+			buf_end = pos + len(buf)
+
+		if pos >= buf_end:
 			break
-		namelen, = struct.unpack("B", namelen)
-		name = stream.read(namelen)
-		if len(name) < namelen:
+
+		rel = pos - base
+		namelen, = unpack_namelen(buf, rel)
+		rel += 1
+		if pos + 1 + namelen > buf_end:
 			raise IOError("unexpected end of file while reading file name")
-		name = name.decode("latin1")
-		if os.path.sep != "\\":
-			name = name.replace("\\",os.path.sep)
-		size = stream.read(4)
-		offset = stream.tell()
-		if len(size) < 4:
+		name = buf[rel:rel + namelen].decode("latin1")
+		if replace_sep:
+			name = name.replace("\\",sep)
+		rel += namelen
+		offset = pos + 1 + namelen + 4
+		if offset > buf_end:
 			raise IOError("unexpected end of file while reading file size")
-		size, = struct.unpack("<I",size)
-		yield name, offset, size
-		stream.seek(offset + size, 0)
-		if offset + size != stream.tell():
-			raise IOError("error seeking to %u" % (offset + size))
+		size, = unpack_size(buf, rel)
+
+		names.append(name)
+		offsets.append(offset)
+		sizes.append(size)
+
+		pos = offset + size
 		i += 1
-	
-	offset = stream.tell()
-	stream.seek(0, 2)
-	end = stream.tell()
-	if offset < end:
-		raise IOError("unexpected trailing %u byte(s)" % (end - offset))
 
-def pack(stream,dirname,remove_ext=True,callback=lambda name: None):
+	if pos < end:
+		raise IOError("unexpected trailing %u byte(s)" % (end - pos))
+
+	return Index(names,offsets,sizes)
+
+# Unlike the old streaming parser this always starts at the beginning of the
+# stream, not at its current position.
+def read_index(stream):
+	return iter(load_index(stream))
+
+class MemberReader(io.RawIOBase):
+	def __init__(self,archive,offset,size):
+		io.RawIOBase.__init__(self)
+		self.archive = archive
+		self.offset  = offset
+		self.size    = size
+		self.pos     = 0
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def readinto(self,buf):
+		count = min(len(buf), self.size - self.pos)
+		if count <= 0:
+			return 0
+		buf[:count] = self.archive.read_range(self.offset + self.pos, count)
+		self.pos += count
+		return count
+
+	def seek(self,pos,whence=0):
+		if whence == 0:
+			pass
+		elif whence == 1:
+			pos += self.pos
+		elif whence == 2:
+			pos += self.size
+		else:
+			raise ValueError("invalid whence: %r" % whence)
+
+		if pos < 0:
+			raise ValueError("negative seek position %d" % pos)
+		self.pos = pos
+		return pos
+
+	def tell(self):
+		return self.pos
+
+class PakArchive(object):
+	__slots__ = 'stream','index','data','names','_owns_stream'
+
+	def __init__(self,archive,index=None):
+		if hasattr(archive, 'read'):
+			self.stream = archive
+			self._owns_stream = False
+		else:
+			self.stream = open(archive,"rb")
+			self._owns_stream = True
+
+		try:
+			self.index = index if index is not None else load_index(self.stream)
+			self.data  = _map_archive(self.stream)
+
+			# doubled names: the last one wins, like when unpacking
+			self.names = dict((name, i) for i, name in enumerate(self.index.names))
+		except:
+			if self._owns_stream:
+				self.stream.close()
+			raise
+
+	def close(self):
+		if self.data is not None:
+			try:
+				self.data.close()
+			except BufferError:
+				# there are still member views around, the map is freed with them
+				pass
+			self.data = None
+
+		if self._owns_stream:
+			self.stream.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,exc_type,exc_value,traceback):
+		self.close()
+
+	def __len__(self):
+		return len(self.names)
+
+	def __iter__(self):
+		return iter(self.names)
+
+	def __contains__(self,name):
+		return name in self.names
+
+	def entry(self,name):
+		i = self.names[name]
+		return self.index.offsets[i], self.index.sizes[i]
+
+	def read_range(self,offset,size):
+		if self.data is not None:
+			return mem_view(self.data,offset,size)
+		self.stream.seek(offset, 0)
+		return self.stream.read(size)
+
+	# Returns a zero-copy view of the member data if the archive could be mapped.
+	def member(self,name):
+		offset, size = self.entry(name)
+		return self.read_range(offset,size)
+
+	def read(self,name):
+		return bytes(self.member(name))
+
+	def open(self,name):
+		offset, size = self.entry(name)
+		return MemberReader(self,offset,size)
+
+INDEX_CACHE_MAGIC   = b'FEZPAKIDX\0'
+INDEX_CACHE_VERSION = 3
+# version, offset item size, has extensions, has order, entry count, st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns
+INDEX_CACHE_HEADER  = struct.Struct("<IBBBxIQQQqq")
+
+if hasattr(array, 'frombytes'):
+	def array_from_bytes(typecode,data):
+		arr = array(typecode)
+		arr.frombytes(data)
+		return arr
+
+	def array_to_bytes(arr):
+		return arr.tobytes()
+else:
+	def array_from_bytes(typecode,data):
+		arr = array(typecode)
+		arr.fromstring(data)
+		return arr
+
+	def array_to_bytes(arr):
+		return arr.tostring()
+
+def index_cache_dir():
+	cache_dir = os.environ.get('FEZPAK_CACHE_DIR')
+	if cache_dir:
+		return cache_dir
+	cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+	return os.path.join(cache_home, 'fezpak')
+
+def index_cache_path(archive):
+	import hashlib
+	archive = os.path.abspath(archive)
+	if not isinstance(archive, bytes):
+		archive = archive.encode(sys.getfilesystemencoding())
+	return os.path.join(index_cache_dir(), hashlib.sha1(archive).hexdigest() + '.idx')
+
+# The mtime can be set back with utime() after the archive was rewritten in
+# place, the ctime can't.
+def _archive_key(st):
+	if HAS_STAT_NS:
+		mtime_ns = st.st_mtime_ns
+		ctime_ns = st.st_ctime_ns
+	else:
+		mtime_ns = int(st.st_mtime * 1000000000)
+		ctime_ns = int(st.st_ctime * 1000000000)
+	return st.st_dev, st.st_ino, st.st_size, mtime_ns, ctime_ns
+
+def _pack_strings(strings):
+	blobs   = [string.encode("utf-8") for string in strings]
+	lengths = array(OFFSET_TYPECODE, (len(blob) for blob in blobs))
+	return array_to_bytes(lengths) + b''.join(blobs)
+
+def _unpack_strings(data,pos,count):
+	itemsize = array(OFFSET_TYPECODE).itemsize
+	end = pos + count * itemsize
+	lengths = array_from_bytes(OFFSET_TYPECODE, data[pos:end])
+	strings = []
+	pos = end
+	for length in lengths:
+		end = pos + length
+		strings.append(data[pos:end].decode("utf-8"))
+		pos = end
+	return strings, pos
+
+def read_index_cache(cache_path,st):
+	try:
+		with open(cache_path,"rb") as fp:
+			data = fp.read()
+	except (IOError, OSError):
+		return None
+
+	if not data.startswith(INDEX_CACHE_MAGIC):
+		return None
+
+	pos = len(INDEX_CACHE_MAGIC)
+	if len(data) < pos + INDEX_CACHE_HEADER.size:
+		return None
+
+	header = INDEX_CACHE_HEADER.unpack_from(data, pos)
+	version, itemsize, has_exts, has_order, count = header[:5]
+	if version != INDEX_CACHE_VERSION or itemsize != array(OFFSET_TYPECODE).itemsize or \
+			header[5:] != _archive_key(st):
+		return None
+
+	pos += INDEX_CACHE_HEADER.size
+	try:
+		end = pos + count * itemsize
+		offsets = array_from_bytes(OFFSET_TYPECODE, data[pos:end])
+		pos = end
+		end = pos + count * itemsize
+		sizes = array_from_bytes(OFFSET_TYPECODE, data[pos:end])
+		pos = end
+		names, pos = _unpack_strings(data, pos, count)
+		if has_exts:
+			exts, pos = _unpack_strings(data, pos, count)
+		else:
+			exts = None
+		if has_order:
+			end = pos + count * array(ORDER_TYPECODE).itemsize
+			order = array_from_bytes(ORDER_TYPECODE, data[pos:end])
+			pos = end
+		else:
+			order = None
+	except (ValueError, UnicodeDecodeError):
+		return None
+
+	if pos != len(data) or len(offsets) != count or len(sizes) != count or \
+			(order is not None and len(order) != count):
+		return None
+
+	return Index(names,offsets,sizes,exts,order)
+
+def write_index_cache(cache_path,st,index):
+	header = INDEX_CACHE_HEADER.pack(INDEX_CACHE_VERSION, array(OFFSET_TYPECODE).itemsize,
+		index.exts is not None, index.order is not None, len(index), *_archive_key(st))
+
+	tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+	try:
+		cache_dir = os.path.dirname(cache_path)
+		if not os.path.exists(cache_dir):
+			os.makedirs(cache_dir)
+
+		with open(tmp_path,"wb") as fp:
+			fp.write(INDEX_CACHE_MAGIC)
+			fp.write(header)
+			fp.write(array_to_bytes(index.offsets))
+			fp.write(array_to_bytes(index.sizes))
+			fp.write(_pack_strings(index.names))
+			if index.exts is not None:
+				fp.write(_pack_strings(index.exts))
+			if index.order is not None:
+				fp.write(array_to_bytes(index.order))
+		os.rename(tmp_path, cache_path)
+	except (IOError, OSError):
+		# the cache is only an optimization
+		try:
+			os.remove(tmp_path)
+		except OSError:
+			pass
+		return False
+
+	return True
+
+def cached_index(stream,cache_path=None,guess_extension=False,rebuild=False):
+	if cache_path is None:
+		cache_path = index_cache_path(stream.name)
+	st = os.fstat(stream.fileno())
+
+	with stats_phase('read_index_cache'):
+		index = None if rebuild else read_index_cache(cache_path,st)
+	if index is not None and (index.exts is not None or not guess_extension):
+		stats_count('index_cache.hits')
+		return index
+
+	stats_count('index_cache.misses')
+
+	if index is None:
+		index = load_index(stream)
+
+	if guess_extension:
+		with stats_phase('guess_extensions'):
+			index.exts = guess_extensions(stream,index)
+
+	# so selective operations can jump to the matching entries next time
+	index_order(index)
+
+	with stats_phase('write_index_cache'):
+		write_index_cache(cache_path,st,index)
+	return index
+
+def index_order(index):
+	if index.order is None:
+		names = index.names
+		index.order = array(ORDER_TYPECODE, sorted(range(len(names)), key=names.__getitem__))
+	return index.order
+
+# Sequence of the names of an index in sorted order, for bisect.
+class SortedNames(object):
+	__slots__ = 'names','order'
+
+	def __init__(self,index):
+		self.names = index.names
+		self.order = index_order(index)
+
+	def __len__(self):
+		return len(self.order)
+
+	def __getitem__(self,i):
+		return self.names[self.order[i]]
+
+def index_ext_func(index):
+	exts = dict(izip(index.offsets,index.exts))
+	return lambda stream, offset, size: exts[offset]
+
+def pack(stream,dirname,remove_ext=True,callback=lambda name: None,jobs=1):
 	files = []
 	for dirpath, dirnames, filenames in os.walk(dirname):
 		for filename in filenames:
 			files.append(os.path.join(dirpath,filename))
-	_pack_files(stream,files,remove_ext,callback)
+	_pack_files(stream,files,remove_ext,callback,jobs)
 
-def unpack(stream,outdir=".",ext_func=lambda stream,offset,size:'',callback=lambda name: None):
-	for name, offset, size in read_index(stream):
-		unpack_file(stream,name,offset,size,outdir,ext_func,callback)
+def unpack(stream,outdir=".",ext_func=lambda stream,offset,size:'',callback=lambda name: None,index=None,jobs=1,dedup=None):
+	if index is None:
+		index = read_index(stream)
+	return unpack_entries(stream,index,outdir,ext_func,callback,jobs,dedup)
 
 def shall_unpack(paths,name):
-	path = name.split(os.path.sep)
-	for i in range(1,len(path)+1):
-		prefix = os.path.join(*path[0:i])
-		if prefix in paths:
+	sep = os.path.sep
+	i = name.find(sep)
+	while i >= 0:
+		if name[:i] in paths:
 			return True
-	return False
+		i = name.find(sep,i+1)
+	return name in paths
+
+# Compiles the paths (files or directories) into a prefix trie of their
+# components and returns a function that tells if a name is selected by them.
+def path_matcher(paths):
+	sep = os.path.sep
+	trie = {}
+	for path in paths:
+		node = trie
+		for part in path.split(sep):
+			node = node.setdefault(part,{})
+		# None marks the end of a path
+		node[None] = None
+
+	def matches(name):
+		node = trie
+		for part in name.split(sep):
+			node = node.get(part)
+			if node is None:
+				return False
+			if None in node:
+				return True
+		return False
+
+	return matches
+
+# Returns the positions of the entries that are selected by the paths in
+# archive order. Only looks at the matching ranges of the sorted names.
+def select_entries(index,paths):
+	sep = os.path.sep
+	after_sep = chr(ord(sep) + 1)
+	keys  = SortedNames(index)
+	order = keys.order
+	selected = set()
+	for path in paths:
+		# the path itself and everything below it
+		selected.update(order[bisect_left(keys,path):bisect_right(keys,path)])
+		selected.update(order[bisect_left(keys,path + sep):bisect_left(keys,path + after_sep)])
+	return sorted(selected)
+
+def unpack_files(stream,files,outdir=".",ext_func=lambda stream,offset,size:'',callback=lambda name: None,index=None,jobs=1,dedup=None):
+	if isinstance(index, Index):
+		entries = [index[i] for i in select_entries(index,files)]
+	else:
+		if index is None:
+			index = read_index(stream)
+		matches = path_matcher(files)
+		entries = (entry for entry in index if matches(entry[0]))
+	return unpack_entries(stream,entries,outdir,ext_func,callback,jobs,dedup)
+
+# Compiles glob patterns (or regular expressions if regex is true) into one
+# expression and returns a function that tells if a name is matched by any of
+# them. Patterns have to match the whole name.
+def name_matcher(patterns,regex=False):
+	import re
+	if not regex:
+		from fnmatch import translate
+		expr = re.compile('|'.join('(?:%s)' % translate(pattern) for pattern in patterns), re.S)
+		return lambda name: expr.match(name) is not None
+
+	# user patterns may start with global flags like (?i), so they can't be joined
+	if hasattr(re.compile(''), 'fullmatch'):
+		exprs = [re.compile(pattern, re.S).fullmatch for pattern in patterns]
+	else:
+		exprs = [re.compile('(?:%s)\\Z' % pattern, re.S).match for pattern in patterns]
+	return lambda name: any(match(name) is not None for match in exprs)
+
+def select_members(index,patterns,regex=False):
+	matches = name_matcher(patterns,regex)
+	return [entry for entry in index if matches(entry[0])]
+
+# Writes the data of all members matched by patterns to out, one after
+# another in archive order, with sendfile(). Returns the number of members.
+def cat_members(stream,out,patterns,regex=False,callback=lambda name: None,index=None):
+	if index is None:
+		index = read_index(stream)
+
+	# the index is in archive order, so the archive is read front to back
+	entries = select_members(index,patterns,regex)
+	for name, offset, size in entries:
+		callback(name)
+		sendfile(out,stream,offset,size)
+	out.flush()
+
+	return len(entries)
 
-def unpack_files(stream,files,outdir=".",ext_func=lambda stream,offset,size:'',callback=lambda name: None):
-	for name, offset, size in read_index(stream):
-		if shall_unpack(files,name):
-			unpack_file(stream,name,offset,size,outdir,ext_func,callback)
+# Returns the number of bytes saved by deduplication.
+def unpack_entries(stream,entries,outdir=".",ext_func=lambda stream,offset,size:'',callback=lambda name: None,jobs=1,dedup=None):
+	return _unpack_planned(stream,entries,outdir,ext_func,callback,jobs,dedup)
 
 def unpack_file(stream,name,offset,size,outdir=".",ext_func=lambda stream,offset,size:'',callback=lambda name: None):
 	prefix, name = os.path.split(name)
 	prefix = os.path.join(outdir,prefix)
-	if not os.path.exists(prefix):
-		os.makedirs(prefix)
+	with stats_phase('unpack.makedirs'):
+		if not os.path.exists(prefix):
+			os.makedirs(prefix)
 	ext = ext_func(stream,offset,size)
 	name = os.path.join(prefix,name)+ext
 	callback(name)
-	with open(name,"wb") as fp:
-		sendfile(fp,stream,offset,size)
+	with stats_phase('unpack.write'):
+		with open(name,"wb") as fp:
+			sendfile(fp,stream,offset,size)
+
+# Returns False if the parent directory is missing and missing_ok is set.
+def _mkdir(path,missing_ok=False):
+	try:
+		os.mkdir(path)
+	except OSError as exc:
+		if exc.errno == errno.ENOENT and missing_ok:
+			return False
+		if exc.errno != errno.EEXIST or not os.path.isdir(path):
+			raise
+	return True
+
+def _imap(pool,func,items):
+	if pool is None:
+		return (func(item) for item in items)
+	else:
+		return pool.imap(func,items)
+
+def _find_duplicates(stream,tasks,candidates,pool):
+	by_size = {}
+	for i in candidates:
+		size = tasks[i][2]
+		if size > 0:
+			by_size.setdefault(size, []).append(i)
+
+	# only entries that share their size with another entry need to be hashed
+	hashed = [i for i in candidates if len(by_size.get(tasks[i][2], ())) > 1]
+	if not hashed:
+		return {}
+
+	mem = _map_archive(stream)
+	try:
+		if mem is None:
+			digests = [hash_member(stream,tasks[i][1],tasks[i][2]) for i in hashed]
+		else:
+			digests = list(_imap(pool,lambda i: hash_member(stream,tasks[i][1],tasks[i][2],mem),hashed))
+	finally:
+		if mem is not None:
+			mem.close()
+
+	sources = {}
+	links   = {}
+	for i, digest in izip(hashed, digests):
+		key = (tasks[i][2], digest)
+		source = sources.get(key)
+		if source is None:
+			sources[key] = i
+		else:
+			links[i] = source
+	return links
+
+HAS_DIR_FD = os.open in getattr(os, 'supports_dir_fd', ())
+
+# well below the usual limit of 1024 open files
+DIR_FD_CACHE_SIZE = 512
+DIR_OPEN_FLAGS  = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) | getattr(os, 'O_CLOEXEC', 0)
+FILE_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0) | getattr(os, 'O_CLOEXEC', 0)
+
+# Creates all directories needed for a set of files in one pass (parents
+# first, so every directory costs a single mkdir) and then creates the files
+# relative to open directory fds, so their paths don't need to be resolved
+# again for every file. Files are preallocated to their final size.
+class ExtractionPlanner(object):
+	__slots__ = 'dirs','fds','lock','preallocate'
+
+	def __init__(self,paths):
+		import threading
+		from collections import OrderedDict
+
+		dirs = set()
+		for path in paths:
+			path = os.path.dirname(path)
+			while path and path not in dirs:
+				dirs.add(path)
+				parent = os.path.dirname(path)
+				if parent == path:
+					break
+				path = parent
+
+		self.dirs = dirs
+		# the most recently used directory fds: dirname -> [fd, users, cached]
+		self.fds  = OrderedDict()
+		self.lock = threading.Lock()
+		self.preallocate = hasattr(os, 'posix_fallocate')
+
+	# Parents are created before their children with one mkdir() each. The
+	# planned directories include all ancestors of the output directory, so
+	# the top of every chain is probed from its bottom up to the first one
+	# that exists, everything above it is known to exist.
+	def make_dirs(self):
+		dirs = self.dirs
+		children = {}
+		for path in dirs:
+			parent = os.path.dirname(path)
+			if parent != path and parent in dirs:
+				children.setdefault(parent, []).append(path)
+
+		created = set()
+		for path in sorted(dirs):
+			if path in created:
+				continue
+
+			if os.path.dirname(path) in created:
+				_mkdir(path)
+				created.add(path)
+				continue
+
+			bottom = path
+			while len(children.get(bottom, ())) == 1:
+				bottom = children[bottom][0]
+
+			missing = []
+			while not _mkdir(bottom,bottom != path):
+				missing.append(bottom)
+				bottom = os.path.dirname(bottom)
+
+			while True:
+				created.add(bottom)
+				if bottom == path:
+					break
+				bottom = os.path.dirname(bottom)
+
+			for missing_path in reversed(missing):
+				_mkdir(missing_path)
+				created.add(missing_path)
+
+	def _open(self,path):
+		if not HAS_DIR_FD:
+			return os.open(path, FILE_OPEN_FLAGS, 0o666)
+
+		dirname, name = os.path.split(path)
+		entry = self._acquire_dir(dirname)
+		try:
+			return os.open(name, FILE_OPEN_FLAGS, 0o666, dir_fd=entry[0])
+		finally:
+			self._release_dir(entry)
+
+	# The lock only guards the cache, the system calls happen outside of it.
+	# Directory fds that are evicted while in use are closed by their last user.
+	def _acquire_dir(self,dirname):
+		fds = self.fds
+		with self.lock:
+			entry = fds.pop(dirname, None)
+			if entry is not None:
+				entry[1] += 1
+				fds[dirname] = entry
+				return entry
+
+		fd = os.open(dirname or ".", DIR_OPEN_FLAGS)
+		evicted = []
+		with self.lock:
+			entry = fds.pop(dirname, None)
+			if entry is None:
+				entry = [fd, 1, True]
+				fd = None
+				while len(fds) >= DIR_FD_CACHE_SIZE:
+					old = fds.popitem(last=False)[1]
+					old[2] = False
+					if old[1] == 0:
+						evicted.append(old[0])
+			else:
+				# another thread was faster
+				entry[1] += 1
+			fds[dirname] = entry
+
+		if fd is not None:
+			os.close(fd)
+		for old_fd in evicted:
+			os.close(old_fd)
+		return entry
+
+	def _release_dir(self,entry):
+		with self.lock:
+			entry[1] -= 1
+			unused = entry[1] == 0 and not entry[2]
+		if unused:
+			os.close(entry[0])
+
+	def write(self,path,stream,offset,size):
+		fd = self._open(path)
+		try:
+			fp = os.fdopen(fd,"wb")
+		except:
+			os.close(fd)
+			raise
+
+		with fp:
+			if size > 0 and self.preallocate:
+				try:
+					os.posix_fallocate(fd, 0, size)
+				except OSError as exc:
+					if exc.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS):
+						raise
+					self.preallocate = False
+			sendfile(fp,stream,offset,size)
+
+	def close(self):
+		with self.lock:
+			while self.fds:
+				entry = self.fds.popitem()[1]
+				entry[2] = False
+				if entry[1] == 0:
+					os.close(entry[0])
+
+def _unpack_planned(stream,entries,outdir,ext_func,callback,jobs,dedup):
+	import threading
+
+	# ext_func might seek the shared stream, so it is only called from this thread
+	tasks = []
+	with stats_phase('unpack.plan'):
+		for name, offset, size in entries:
+			path = os.path.join(outdir,name)+ext_func(stream,offset,size)
+			tasks.append((path, offset, size))
+
+	# doubled names: only the last occurance is written, like in the serial case
+	last = {}
+	for i, (path, offset, size) in enumerate(tasks):
+		last[path] = i
+
+	# read the archive front to back
+	order = sorted(range(len(tasks)), key=lambda i: tasks[i][1])
+
+	if sendfile is highlevel_sendfile and jobs > 1:
+		# highlevel_sendfile seeks, so every worker needs its own file object
+		local = threading.local()
+		infiles = []
+		def get_infile():
+			infile = getattr(local, 'infile', None)
+			if infile is None:
+				infile = local.infile = open(stream.name,"rb")
+				infiles.append(infile)
+			return infile
+	else:
+		infiles = []
+		get_infile = lambda: stream
+
+	if jobs > 1:
+		from multiprocessing.pool import ThreadPool
+		pool = ThreadPool(jobs)
+	else:
+		pool = None
+
+	planner = ExtractionPlanner(path for path, offset, size in tasks)
+	try:
+		with stats_phase('unpack.makedirs'):
+			planner.make_dirs()
+
+		if dedup is not None:
+			with stats_phase('unpack.find_duplicates'):
+				links = _find_duplicates(stream,tasks,[i for i in order if last[tasks[i][0]] == i],pool)
+		else:
+			links = {}
+
+		def unpack_task(i):
+			path, offset, size = tasks[i]
+			if last[path] == i and i not in links:
+				with stats_phase('unpack.write'):
+					planner.write(path,get_infile(),offset,size)
+			return i
+
+		saved = 0
+		# imap() returns results in submission order, so callbacks are deterministic
+		for i in _imap(pool,unpack_task,order):
+			path, offset, size = tasks[i]
+			source = links.get(i)
+			if source is not None:
+				# the source has a lower offset and is therefore already written
+				with stats_phase('unpack.link'):
+					if link_file(tasks[source][0],path,dedup):
+						saved += size
+			callback(path)
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+		planner.close()
+		for infile in infiles:
+			infile.close()
+
+	return saved
 
 def pack_buffers(stream,buffers,callback=lambda name: None):
-	stream.write(struct.pack("<I",len(buffers)))
-	for name, data in sorted(buffers,key=lambda item: item[0]):
-		callback(name)
-		write_entry_header(stream,name,len(data))
-		stream.write(data)
+	with PakWriter(stream,len(buffers)) as writer:
+		for name, data in sorted(buffers,key=lambda item: item[0]):
+			callback(name)
+			writer.add(name,data)
+
+MAX_ENTRY_SIZE  = 2 ** 32 - 1
+SPOOL_MAX_SIZE  = 2 ** 24
+COPY_CHUNK_SIZE = 2 ** 20
+
+def _is_seekable(stream):
+	try:
+		if hasattr(stream, 'seekable'):
+			return stream.seekable()
+		stream.tell()
+	except (AttributeError, IOError, OSError, ValueError):
+		return False
+	else:
+		return True
+
+def _iter_chunks(data):
+	if hasattr(data, 'read'):
+		while True:
+			chunk = data.read(COPY_CHUNK_SIZE)
+			if not chunk:
+				break
+			yield chunk
+	else:
+		for chunk in data:
+			yield chunk
+
+# Writes an archive entry by entry with constant memory. Data can be a
+# bytes-like object, a file-like object or an iterable of bytes chunks.
+# On seekable streams the entry sizes and the entry count are patched in
+# afterwards, otherwise the count must be given up front and members of
+# unknown size are spooled to a temporary file first.
+class PakWriter(object):
+	__slots__ = 'stream','count','expected_count','seekable','base'
+
+	def __init__(self,stream,count=None):
+		self.stream   = stream
+		self.count    = 0
+		self.expected_count = count
+		self.seekable = _is_seekable(stream)
+
+		if not self.seekable and count is None:
+			raise ValueError("number of entries must be known when writing to a non-seekable stream")
+
+		self.base = stream.tell() if self.seekable else 0
+		stream.write(HEADER_STRUCT.pack(count or 0))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,exc_type,exc_value,traceback):
+		if exc_type is None:
+			self.close()
+
+	def add(self,name,data,size=None):
+		stream = self.stream
+		if isinstance(data, (bytes, bytearray, memoryview)):
+			stream.write(entry_header(name,len(data)))
+			stream.write(data)
+
+		elif size is not None:
+			stream.write(entry_header(name,size))
+			written = 0
+			for chunk in _iter_chunks(data):
+				written += len(chunk)
+				if written > size:
+					raise IOError("member %s is bigger than the given size (%u)" % (name, size))
+				stream.write(chunk)
+			if written != size:
+				raise IOError("member %s is smaller than the given size (%u)" % (name, size))
+
+		elif self.seekable:
+			header = entry_header(name,0)
+			header_pos = stream.tell()
+			stream.write(header)
+			size = 0
+			for chunk in _iter_chunks(data):
+				size += len(chunk)
+				stream.write(chunk)
+
+			if size > MAX_ENTRY_SIZE:
+				raise IOError("member %s is too big (%u bytes)" % (name, size))
+
+			end = stream.tell()
+			stream.seek(header_pos + len(header) - SIZE_STRUCT.size, 0)
+			stream.write(SIZE_STRUCT.pack(size))
+			stream.seek(end, 0)
+
+		else:
+			from tempfile import SpooledTemporaryFile
+			with SpooledTemporaryFile(SPOOL_MAX_SIZE) as spool:
+				for chunk in _iter_chunks(data):
+					spool.write(chunk)
+				size = spool.tell()
+				spool.seek(0, 0)
+				self.add(name,spool,size)
+				return
+
+		self.count += 1
+
+	def close(self):
+		if self.seekable:
+			end = self.stream.tell()
+			self.stream.seek(self.base, 0)
+			self.stream.write(HEADER_STRUCT.pack(self.count))
+			self.stream.seek(end, 0)
+
+		elif self.count != self.expected_count:
+			raise IOError("%u entries written, but %u announced" % (self.count, self.expected_count))
+
+		self.stream.flush()
+
+def entry_header(name,size):
+	name = name.replace(os.path.sep,"\\").encode("utf-8","surrogateescape")
+	return NAMELEN_STRUCT.pack(len(name)) + name + SIZE_STRUCT.pack(size)
 
 def write_entry_header(stream,name,size):
-	name = name.replace(os.path.sep,"\\").encode("utf-8")
-	stream.write(struct.pack("B",len(name)))
-	stream.write(name)
-	stream.write(struct.pack("<I",size))
+	stream.write(entry_header(name,size))
+
+def pack_files(stream,files_or_dirs,remove_ext=True,callback=lambda name: None,jobs=1):
+	_pack_files(stream,list_files(files_or_dirs),remove_ext,callback,jobs)
 
-def pack_files(stream,files_or_dirs,remove_ext=True,callback=lambda name: None):
+def list_files(files_or_dirs):
 	files = []
 	for name in files_or_dirs:
 		if os.path.isdir(name):
@@ -233,20 +1437,969 @@ def pack_files(stream,files_or_dirs,remove_ext=True,callback=lambda name: None):
 					files.append(os.path.join(dirpath,filename))
 		else:
 			files.append(name)
-	_pack_files(stream,files,remove_ext,callback)
+	return files
 
-def _pack_files(stream,files,remove_ext=True,callback=lambda name: None):
+def _pack_files(stream,files,remove_ext=True,callback=lambda name: None,jobs=1):
 	files.sort()
+	if jobs > 1 and HAS_PWRITE:
+		try:
+			out_fd = stream.fileno()
+			stream.flush()
+			base = stream.tell()
+		except (AttributeError, IOError, OSError, ValueError):
+			pass
+		else:
+			_parallel_pack_files(stream,out_fd,base,files,remove_ext,callback,jobs)
+			return
+
 	stream.write(struct.pack("<I",len(files)))
 	for name in files:
+		with stats_phase('pack.write'):
+			with open(name,"rb") as infile:
+				infile.seek(0,2)
+				size = infile.tell()
+				if remove_ext:
+					name = os.path.splitext(name)[0]
+				callback(name)
+				write_entry_header(stream,name,size)
+				sendfile(stream,infile,0,size)
+
+def copy_to_offset(out_fd,in_fd,offset,size):
+	pos = 0
+	calls = 0
+	if hasattr(os, 'copy_file_range'):
+		try:
+			while pos < size:
+				calls += 1
+				count = os.copy_file_range(in_fd, out_fd, size - pos, pos, offset + pos)
+				if count == 0:
+					raise IOError("unexpected end of file")
+				pos += count
+		except OSError as exc:
+			if exc.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+				raise
+			stats_count('fallbacks.copy_file_range')
+		else:
+			stats = STATS
+			if stats is not None:
+				stats.count('syscalls.copy_file_range',calls)
+				stats.count('bytes.copy_file_range',size)
+			return
+
+	start = pos
+	reads = writes = 0
+	while pos < size:
+		reads += 1
+		data = os.pread(in_fd, min(size - pos, 2 ** 20), pos)
+		if not data:
+			raise IOError("unexpected end of file")
+		written = 0
+		while written < len(data):
+			writes += 1
+			written += os.pwrite(out_fd, data[written:], offset + pos + written)
+		pos += len(data)
+
+	stats = STATS
+	if stats is not None:
+		stats.count('syscalls.pread',reads)
+		stats.count('syscalls.pwrite',writes)
+		stats.count('bytes.pread_pwrite',size - start)
+
+def _parallel_pack_files(stream,out_fd,base,files,remove_ext,callback,jobs):
+	from multiprocessing.pool import ThreadPool
+
+	pool = ThreadPool(jobs)
+	try:
+		# first pass: stat all inputs and lay out the whole archive
+		with stats_phase('pack.layout'):
+			sizes = pool.map(lambda name: os.stat(name).st_size, files)
+
+			layout = []
+			offset = base + HEADER_STRUCT.size
+			for name, size in izip(files, sizes):
+				entry_name = os.path.splitext(name)[0] if remove_ext else name
+				header = entry_header(entry_name,size)
+				layout.append((name, entry_name, header, offset, size))
+				offset += len(header) + size
+			end = offset
+
+		if hasattr(os, 'posix_fallocate') and end > base:
+			try:
+				with stats_phase('pack.fallocate'):
+					os.posix_fallocate(out_fd, base, end - base)
+			except OSError as exc:
+				if exc.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS):
+					raise
+
+		os.pwrite(out_fd, HEADER_STRUCT.pack(len(files)), base)
+
+		def pack_task(entry):
+			name, entry_name, header, offset, size = entry
+			with stats_phase('pack.write'):
+				os.pwrite(out_fd, header, offset)
+				with open(name,"rb") as infile:
+					copy_to_offset(out_fd, infile.fileno(), offset + len(header), size)
+			return entry_name
+
+		# imap() returns results in submission order, so callbacks are deterministic
+		for entry_name in pool.imap(pack_task, layout):
+			callback(entry_name)
+	finally:
+		pool.close()
+		pool.join()
+
+	stream.seek(end, 0)
+
+def move_range(fd,src,dst,size):
+	# dst < src, so copying front to back never overwrites unread data
+	gap = src - dst
+	pos = 0
+	if hasattr(os, 'copy_file_range') and gap >= 2 ** 16:
+		try:
+			while pos < size:
+				# the source and destination ranges of one call must not overlap
+				count = os.copy_file_range(fd, fd, min(size - pos, gap), src + pos, dst + pos)
+				if count == 0:
+					raise IOError("unexpected end of file")
+				pos += count
+			return
+		except OSError as exc:
+			if exc.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+				raise
+
+	while pos < size:
+		data = os.pread(fd, min(size - pos, 2 ** 20), src + pos)
+		if not data:
+			raise IOError("unexpected end of file")
+		written = 0
+		while written < len(data):
+			written += os.pwrite(fd, data[written:], dst + pos + written)
+		pos += len(data)
+
+def _move_range(stream,src,dst,size):
+	if HAS_PWRITE:
+		stream.flush()
+		move_range(stream.fileno(),src,dst,size)
+	else:
+		while size > 0:
+			stream.seek(src, 0)
+			data = stream.read(min(size, 2 ** 20))
+			if not data:
+				raise IOError("unexpected end of file")
+			stream.seek(dst, 0)
+			stream.write(data)
+			src  += len(data)
+			dst  += len(data)
+			size -= len(data)
+
+# Adds, replaces and deletes members of an archive in place. Entries before
+# the first replaced or deleted entry aren't touched, later ones are moved
+# down and new members are appended. Returns the new number of entries.
+def update(stream,files_or_dirs=(),delete=(),remove_ext=False,callback=lambda name: None):
+	index = load_index(stream)
+
+	files = sorted(list_files(files_or_dirs))
+	added = []
+	for name in files:
+		entry_name = os.path.splitext(name)[0] if remove_ext else name
+		added.append((entry_name, name))
+
+	dropped = set(delete)
+	replaced = set(entry_name for entry_name, name in added)
+
+	matches = path_matcher(dropped)
+	keep = [name not in replaced and not matches(name) for name in index.names]
+	try:
+		first = keep.index(False)
+	except ValueError:
+		first = len(index)
+
+	if first < len(index):
+		name = index.names[first]
+		pos = index.offsets[first] - SIZE_STRUCT.size - len(name) - NAMELEN_STRUCT.size
+	else:
+		stream.seek(0, 2)
+		pos = stream.tell()
+
+	# move runs of kept entries over the gaps left by dropped ones
+	i = first
+	count = first
+	while i < len(index):
+		if not keep[i]:
+			i += 1
+			continue
+
+		start = i
+		while i < len(index) and keep[i]:
+			i += 1
+
+		name = index.names[start]
+		run_start = index.offsets[start] - SIZE_STRUCT.size - len(name) - NAMELEN_STRUCT.size
+		run_end   = index.offsets[i - 1] + index.sizes[i - 1]
+		if run_start != pos:
+			_move_range(stream,run_start,pos,run_end - run_start)
+		pos   += run_end - run_start
+		count += i - start
+
+	stream.seek(pos, 0)
+	for entry_name, name in added:
 		with open(name,"rb") as infile:
 			infile.seek(0,2)
 			size = infile.tell()
-			if remove_ext:
-				name = os.path.splitext(name)[0]
-			callback(name)
-			write_entry_header(stream,name,size)
+			header = entry_header(entry_name,size)
+			callback(entry_name)
+			stream.write(header)
 			sendfile(stream,infile,0,size)
+			pos += len(header) + size
+		count += 1
+
+	stream.seek(pos, 0)
+	stream.truncate()
+	stream.seek(0, 0)
+	stream.write(HEADER_STRUCT.pack(count))
+	stream.flush()
+
+	return count
+
+MANIFEST_HEADER = "# fezpak manifest"
+
+# Checks the header and the entry bounds of an archive without reading the
+# member data. Returns the index.
+def check_structure(stream):
+	index = load_index(stream)
+
+	stream.seek(0, 2)
+	end = stream.tell()
+	stream.seek(0, 0)
+	count, = HEADER_STRUCT.unpack(stream.read(HEADER_STRUCT.size))
+
+	# the parser stops at the end of the file, so the last entry might be cut off
+	if index.sizes and index.offsets[-1] + index.sizes[-1] > end:
+		raise IOError("unexpected end of file in member %s" % index.names[-1])
+
+	if count != len(index):
+		raise IOError("archive announces %u entries, but contains %u" % (count, len(index)))
+
+	return index
+
+def member_digests(stream,index,hash_name='sha256',jobs=1,callback=lambda name: None):
+	import hashlib
+	# fail early on unknown hash names
+	hashlib.new(hash_name)
+
+	mem = _map_archive(stream)
+	if mem is None:
+		digests = []
+		for name, offset, size in index:
+			callback(name)
+			digests.append(hash_member(stream,offset,size,None,hash_name))
+		return digests
+
+	pool = None
+	try:
+		entries = list(index)
+		func = lambda entry: hash_member(stream,entry[1],entry[2],mem,hash_name)
+		if jobs > 1:
+			from multiprocessing.pool import ThreadPool
+			pool = ThreadPool(jobs)
+			# hashlib releases the GIL, small members are handed out in batches
+			results = pool.imap(func,entries,64)
+		else:
+			results = (func(entry) for entry in entries)
+
+		digests = []
+		for entry, digest in izip(entries,results):
+			callback(entry[0])
+			digests.append(digest)
+		return digests
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+		mem.close()
+
+def write_manifest(out,index,digests,hash_name='sha256'):
+	from binascii import hexlify
+	out.write("%s %s\n" % (MANIFEST_HEADER, hash_name))
+	_write_batched(out,("%s %u %u %s\n" % (hexlify(digest).decode('ascii'), offset, size, name)
+		for (name, offset, size), digest in izip(index,digests)))
+
+# Returns the hash name and the (name, offset, size, hex digest) entries.
+def read_manifest(fp):
+	header = fp.readline()
+	if not header.startswith(MANIFEST_HEADER):
+		raise ValueError("not a fezpak manifest")
+	hash_name = header[len(MANIFEST_HEADER):].strip()
+
+	entries = []
+	for lineno, line in enumerate(fp, 2):
+		line = line.rstrip("\n")
+		if not line:
+			continue
+		try:
+			digest, offset, size, name = line.split(" ",3)
+			entries.append((name, int(offset), int(size), digest))
+		except ValueError:
+			raise ValueError("invalid manifest line %d: %s" % (lineno, line))
+
+	return hash_name, entries
+
+# Compares an index (and the member digests, if not None) to manifest
+# entries. Doubled names are matched in archive order. Returns a list of
+# (name, problem) tuples.
+def compare_manifest(index,digests,entries):
+	from binascii import hexlify
+
+	expected = {}
+	for name, offset, size, digest in entries:
+		expected.setdefault(name, []).append((offset, size, digest))
+
+	problems = []
+	for i, (name, offset, size) in enumerate(index):
+		candidates = expected.get(name)
+		if not candidates:
+			problems.append((name, "not in manifest"))
+			continue
+
+		expected_offset, expected_size, expected_digest = candidates.pop(0)
+		if size != expected_size:
+			problems.append((name, "size is %u, expected %u" % (size, expected_size)))
+		elif digests is not None and hexlify(digests[i]).decode('ascii') != expected_digest.lower():
+			problems.append((name, "content differs"))
+		elif offset != expected_offset:
+			problems.append((name, "offset is %u, expected %u" % (offset, expected_offset)))
+
+	for name in sorted(expected):
+		for candidate in expected[name]:
+			problems.append((name, "missing"))
+
+	return problems
+
+# Checks the structure of an archive and, unless fast is true, reads and
+# hashes all members on jobs threads. If a manifest (as returned by
+# read_manifest()) is given the archive is compared to it. Returns the index,
+# the digests (None in fast mode) and a list of (name, problem) tuples.
+def verify(stream,manifest=None,hash_name='sha256',jobs=1,fast=False,callback=lambda name: None):
+	index = check_structure(stream)
+
+	if manifest is not None:
+		hash_name = manifest[0]
+
+	if fast:
+		digests = None
+	else:
+		with stats_phase('verify.hash'):
+			digests = member_digests(stream,index,hash_name,jobs,callback)
+
+	if manifest is not None:
+		problems = compare_manifest(index,digests,manifest[1])
+	else:
+		problems = []
+
+	return index, digests, problems
+
+# Returns the start of every entry (its header) in the archive.
+def entry_starts(index):
+	starts = array(OFFSET_TYPECODE)
+	pos = HEADER_STRUCT.size
+	for offset, size in izip(index.offsets, index.sizes):
+		starts.append(pos)
+		pos = offset + size
+	return starts
+
+# Pairs the entries of two archives by name (the n-th occurance of a doubled
+# name with the n-th occurance in the other archive). Only pairs of the same
+# size are hashed. Returns for every new entry the position of the identical
+# old entry (or None), the pairs that differ and the unpaired old entries.
+def match_entries(old_stream,old_index,new_stream,new_index,jobs=1):
+	def keys(index):
+		seen = {}
+		result = []
+		for name in index.names:
+			k = seen.get(name, 0)
+			seen[name] = k + 1
+			result.append((name, k))
+		return result
+
+	old_pos = dict((key, j) for j, key in enumerate(keys(old_index)))
+	sources = [None] * len(new_index)
+	candidates = []
+	changed = []
+	for i, key in enumerate(keys(new_index)):
+		j = old_pos.pop(key, None)
+		if j is None:
+			continue
+		size = new_index.sizes[i]
+		if size != old_index.sizes[j]:
+			changed.append((j, i))
+		elif size == 0:
+			sources[i] = j
+		else:
+			candidates.append((j, i))
+
+	removed = sorted(old_pos.values())
+
+	old_mem = _map_archive(old_stream)
+	new_mem = _map_archive(new_stream)
+	pool = None
+	try:
+		def same(pair):
+			j, i = pair
+			return hash_member(old_stream,old_index.offsets[j],old_index.sizes[j],old_mem) == \
+			       hash_member(new_stream,new_index.offsets[i],new_index.sizes[i],new_mem)
+
+		if jobs > 1 and old_mem is not None and new_mem is not None:
+			from multiprocessing.pool import ThreadPool
+			pool = ThreadPool(jobs)
+			results = pool.imap(same,candidates,16)
+		else:
+			results = (same(pair) for pair in candidates)
+
+		with stats_phase('diff.hash'):
+			for (j, i), equal in izip(candidates,results):
+				if equal:
+					sources[i] = j
+				else:
+					changed.append((j, i))
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+		for mem in (old_mem, new_mem):
+			if mem is not None:
+				mem.close()
+
+	changed.sort(key=lambda pair: pair[1])
+	return sources, changed, removed
+
+# Returns a list of (status, name) tuples sorted by name. Status is 'A' for
+# added, 'D' for deleted and 'M' for modified members.
+def diff_archives(old_stream,new_stream,jobs=1,old_index=None,new_index=None):
+	old_index = as_index(old_index) if old_index is not None else load_index(old_stream)
+	new_index = as_index(new_index) if new_index is not None else load_index(new_stream)
+	sources, changed, removed = match_entries(old_stream,old_index,new_stream,new_index,jobs)
+
+	paired = set(i for j, i in changed)
+	result = [('M', new_index.names[i]) for j, i in changed]
+	result.extend(('D', old_index.names[j]) for j in removed)
+	result.extend(('A', new_index.names[i]) for i, j in enumerate(sources) if j is None and i not in paired)
+	result.sort(key=lambda item: item[1])
+	return result
+
+PATCH_MAGIC   = b'FEZPAKPATCH\0'
+PATCH_VERSION = 2
+# version, old archive size, new archive size, number of operations,
+# SHA-256 of the old archive, SHA-256 of the new archive
+PATCH_HEADER  = struct.Struct("<IQQI32s32s")
+# kind, offset (in the old archive for copies), size
+PATCH_OP      = struct.Struct("<BQQ")
+
+PATCH_COPY = 0
+PATCH_DATA = 1
+
+# Writes a patch that turns the old archive into the new one. Unchanged
+# members (header and data) are copied from the old archive, everything
+# else is stored in the patch together with digests of both archives.
+# Returns the number of bytes taken from the old archive and the number of
+# bytes stored in the patch.
+def write_patch(old_stream,new_stream,out,jobs=1,old_index=None,new_index=None):
+	old_index = as_index(old_index) if old_index is not None else load_index(old_stream)
+	new_index = as_index(new_index) if new_index is not None else load_index(new_stream)
+	sources, changed, removed = match_entries(old_stream,old_index,new_stream,new_index,jobs)
+
+	old_starts = entry_starts(old_index)
+	new_starts = entry_starts(new_index)
+
+	# (kind, offset, size), where data offsets are in the new archive
+	ops = [[PATCH_DATA, 0, HEADER_STRUCT.size]]
+	for i, j in enumerate(sources):
+		if j is None:
+			kind   = PATCH_DATA
+			offset = new_starts[i]
+		else:
+			kind   = PATCH_COPY
+			offset = old_starts[j]
+		size = new_index.offsets[i] + new_index.sizes[i] - new_starts[i]
+
+		last = ops[-1]
+		if last[0] == kind and last[1] + last[2] == offset:
+			last[2] += size
+		else:
+			ops.append([kind, offset, size])
+
+	with stats_phase('patch.hash'):
+		old_size, old_digest = _archive_digest(old_stream)
+		new_size, new_digest = _archive_digest(new_stream)
+
+	out.write(PATCH_MAGIC)
+	out.write(PATCH_HEADER.pack(PATCH_VERSION, old_size, new_size, len(ops), old_digest, new_digest))
+
+	copied = stored = 0
+	for kind, offset, size in ops:
+		out.write(PATCH_OP.pack(kind, offset if kind == PATCH_COPY else 0, size))
+		if kind == PATCH_COPY:
+			copied += size
+		else:
+			sendfile(out,new_stream,offset,size)
+			stored += size
+	out.flush()
+
+	return copied, stored
+
+# Returns the size and SHA-256 digest of a whole archive.
+def _archive_digest(stream):
+	stream.seek(0, 2)
+	size = stream.tell()
+	mem  = _map_archive(stream)
+	try:
+		return size, hash_member(stream,0,size,mem)
+	finally:
+		if mem is not None:
+			mem.close()
+
+def _read_exactly(stream,size):
+	data = stream.read(size)
+	if len(data) != size:
+		raise IOError("unexpected end of patch")
+	return data
+
+# Rebuilds the new archive from the old one and a patch written by
+# write_patch(). Copied ranges are transferred with copy_file_range(). The
+# old archive is checked against its digest before anything is written, the
+# written data is hashed from its sources and checked at the end.
+def apply_patch(old_stream,patch,out):
+	import hashlib
+	if _read_exactly(patch,len(PATCH_MAGIC)) != PATCH_MAGIC:
+		raise IOError("not a fezpak patch")
+
+	version, old_size, new_size, count, old_digest, new_digest = PATCH_HEADER.unpack(_read_exactly(patch,PATCH_HEADER.size))
+	if version != PATCH_VERSION:
+		raise IOError("unsupported patch version: %u" % version)
+
+	with stats_phase('patch.hash'):
+		size, digest = _archive_digest(old_stream)
+	if size != old_size:
+		raise IOError("patch doesn't belong to this archive (size is %u, expected %u)" % (size, old_size))
+	if digest != old_digest:
+		raise IOError("patch doesn't belong to this archive (checksum mismatch)")
+
+	hasher  = hashlib.sha256()
+	old_mem = _map_archive(old_stream)
+	try:
+		written = 0
+		for k in range(count):
+			kind, offset, size = PATCH_OP.unpack(_read_exactly(patch,PATCH_OP.size))
+			if kind == PATCH_COPY:
+				if offset + size > old_size:
+					raise IOError("patch copies beyond the end of the archive")
+				hash_range(hasher,old_stream,offset,size,old_mem)
+				copy_range(out,old_stream,offset,size)
+			elif kind == PATCH_DATA:
+				pos = patch.tell()
+				hash_range(hasher,patch,pos,size)
+				sendfile(out,patch,pos,size)
+				patch.seek(pos + size, 0)
+			else:
+				raise IOError("invalid patch operation: %u" % kind)
+			written += size
+	finally:
+		if old_mem is not None:
+			old_mem.close()
+
+	if written != new_size:
+		raise IOError("patch produced %u bytes, expected %u" % (written, new_size))
+	if hasher.digest() != new_digest:
+		raise IOError("patch produced a corrupt archive (checksum mismatch)")
+	out.flush()
+
+def archive_format(path,default='tar'):
+	return 'zip' if path.lower().endswith('.zip') else default
+
+def _export_name(name,ext):
+	if os.path.sep != '/':
+		name = name.replace(os.path.sep,'/')
+	return name + ext
+
+# name are the raw bytes from the tar or zip file. PakWriter encodes names as
+# UTF-8, surrogates keep bytes that aren't valid UTF-8.
+def _import_name(name,remove_ext):
+	name = name.decode('utf-8','surrogateescape').lstrip('/')
+	while name.startswith('./'):
+		name = name[2:]
+	if os.path.sep != '/':
+		name = name.replace('/',os.path.sep)
+	if remove_ext:
+		name = os.path.splitext(name)[0]
+	return name
+
+# Member names are latin1 decoded bytes. tar and zip files get the very same
+# bytes, so names that aren't ASCII survive the round trip unchanged. These
+# return the raw bytes of a tar or zip member name.
+ZIP_UTF8_FLAG = 0x800
+
+def _tar_member_name(member):
+	name = member.name
+	if isinstance(name, bytes):
+		# Python 2 keeps the encoded names
+		return name
+	if 'path' in member.pax_headers:
+		# pax names are always decoded as UTF-8
+		return name.encode('utf-8','surrogateescape')
+	return name.encode('latin1')
+
+def _zip_member_name(info):
+	name = info.filename
+	if isinstance(name, bytes):
+		# Python 2 doesn't decode names without the UTF-8 flag
+		return name
+	return name.encode('utf-8' if info.flag_bits & ZIP_UTF8_FLAG else 'cp437')
+
+# Writes all members of a .pak archive to a tar or (uncompressed) zip
+# stream. out doesn't need to be seekable.
+def export_archive(stream,out,fmt='tar',ext_func=lambda stream,offset,size:'',callback=lambda name: None,index=None):
+	mtime = os.fstat(stream.fileno()).st_mtime
+	with PakArchive(stream,index) as archive:
+		entries = [(_export_name(name,ext_func(stream,offset,size)), offset, size) for name, offset, size in archive.index]
+
+		if fmt == 'tar':
+			_export_tar(archive,out,entries,mtime,callback)
+		elif fmt == 'zip':
+			_export_zip(archive,out,entries,mtime,callback)
+		else:
+			raise ValueError("unknown archive format: %s" % fmt)
+
+def _export_tar(archive,out,entries,mtime,callback):
+	import tarfile
+
+	# headers are written by tarfile, data goes directly from the archive
+	written = 0
+	for name, offset, size in entries:
+		callback(name)
+		info = tarfile.TarInfo(name)
+		info.size  = size
+		info.mtime = int(mtime)
+		info.mode  = 0o644
+		header = info.tobuf(tarfile.GNU_FORMAT, "latin1", "strict")
+		out.write(header)
+		sendfile(out,archive.stream,offset,size)
+		padding = -size % tarfile.BLOCKSIZE
+		if padding:
+			out.write(b"\0" * padding)
+		written += len(header) + size + padding
+
+	# end of archive marker, padded to a whole record like tarfile does
+	written += 2 * tarfile.BLOCKSIZE
+	out.write(b"\0" * (2 * tarfile.BLOCKSIZE + (-written % tarfile.RECORDSIZE)))
+	out.flush()
+
+def _export_zip(archive,out,entries,mtime,callback):
+	import zipfile
+	import time
+
+	class ZipInfo(zipfile.ZipInfo):
+		def _encodeFilenameFlags(self):
+			name = self.filename.encode('latin1')
+			try:
+				name.decode('ascii')
+			except UnicodeDecodeError:
+				try:
+					name.decode('utf-8')
+				except UnicodeDecodeError:
+					pass
+				else:
+					# let other tools show the real name
+					return name, self.flag_bits | ZIP_UTF8_FLAG
+			return name, self.flag_bits
+
+	date_time = time.localtime(mtime)[:6]
+	if date_time[0] < 1980:
+		date_time = (1980, 1, 1, 0, 0, 0)
+
+	with zipfile.ZipFile(out,"w",zipfile.ZIP_STORED,True) as zf:
+		for name, offset, size in entries:
+			callback(name)
+			info = ZipInfo(name,date_time)
+			info.compress_type = zipfile.ZIP_STORED
+			info.external_attr = 0o644 << 16
+			info.file_size     = size
+			data = archive.read_range(offset,size)
+
+			if sys.version_info >= (3, 6):
+				# stream the member, works for non-seekable outputs too
+				with zf.open(info,"w",force_zip64=size >= zipfile.ZIP64_LIMIT) as fp:
+					for pos in range(0,size,COPY_CHUNK_SIZE):
+						fp.write(data[pos:pos + COPY_CHUNK_SIZE])
+			else:
+				zf.writestr(info,bytes(data))
+			del data
+	out.flush()
+
+# Reads size bytes at offset of a stream that is being appended to.
+def _read_back(stream,offset,size):
+	while size > 0:
+		end = stream.tell()
+		stream.seek(offset, 0)
+		chunk = stream.read(min(size, COPY_CHUNK_SIZE))
+		stream.seek(end, 0)
+		if not chunk:
+			raise IOError("unexpected end of file")
+		offset += len(chunk)
+		size   -= len(chunk)
+		yield chunk
+
+# Creates a .pak archive from a tar (optionally compressed, stream is read
+# sequentially) or zip archive. Members keep the order of the source. zip
+# files are read from the central directory at their end, so a non-seekable
+# zip input (e.g. a pipe) is spooled to a temporary file first. tar hard
+# links get the data of their target, which is read back from stream if it
+# is readable. Members that can't be stored (e.g. symbolic links) are skipped
+# and reported with an IOError once the archive is complete.
+def import_archive(infile,stream,fmt='tar',remove_ext=False,callback=lambda name: None):
+	skipped = []
+	with PakWriter(stream) as writer:
+		if fmt == 'tar':
+			import tarfile
+			readable = getattr(stream, 'readable', lambda: False)()
+			# tar name -> (offset, size) of its data in stream
+			written = {}
+			tar = tarfile.open(fileobj=infile,mode="r|*",encoding="latin1")
+			try:
+				for member in tar:
+					if member.isdir():
+						continue
+
+					if member.isfile():
+						name = _import_name(_tar_member_name(member),remove_ext)
+						callback(name)
+						writer.add(name,tar.extractfile(member),member.size)
+						written[member.name] = (stream.tell() - member.size, member.size)
+
+					elif member.islnk() and readable and member.linkname in written:
+						# the stream can't go back to the target, but the archive can
+						offset, size = written[member.linkname]
+						name = _import_name(_tar_member_name(member),remove_ext)
+						callback(name)
+						writer.add(name,_read_back(stream,offset,size),size)
+						written[member.name] = (stream.tell() - size, size)
+
+					else:
+						skipped.append(member.name)
+			finally:
+				tar.close()
+
+		elif fmt == 'zip':
+			import zipfile
+			from tempfile import SpooledTemporaryFile
+			spool = None
+			try:
+				if not _is_seekable(infile):
+					spool = SpooledTemporaryFile(SPOOL_MAX_SIZE)
+					for chunk in _iter_chunks(infile):
+						spool.write(chunk)
+					spool.seek(0, 0)
+					infile = spool
+
+				with zipfile.ZipFile(infile) as zf:
+					for info in zf.infolist():
+						if info.filename.endswith('/'):
+							continue
+						name = _import_name(_zip_member_name(info),remove_ext)
+						callback(name)
+						fp = zf.open(info)
+						try:
+							writer.add(name,fp,info.file_size)
+						finally:
+							fp.close()
+			finally:
+				if spool is not None:
+					spool.close()
+		else:
+			raise ValueError("unknown archive format: %s" % fmt)
+
+	if skipped:
+		raise IOError("skipped %u member(s) that aren't regular files: %s" % (len(skipped), ", ".join(skipped)))
+
+	return writer.count
+
+SERVE_MAX_CONNECTIONS = 64
+SERVE_TIMEOUT = 60
+
+# Parses a HTTP Range header for a single byte range. Returns (start, end) or
+# None if the whole member shall be sent (no, invalid or multiple ranges).
+# Raises ValueError if the range can't be satisfied.
+def parse_range(header,size):
+	if not header or not header.startswith('bytes='):
+		return None
+
+	spec = header[6:].strip()
+	if ',' in spec:
+		return None
+
+	first, sep, last = spec.partition('-')
+	first = first.strip()
+	last  = last.strip()
+	if not sep or not (first or last) or (first and not first.isdigit()) or (last and not last.isdigit()):
+		return None
+
+	if not first:
+		# suffix range: the last N bytes
+		length = int(last)
+		if length == 0:
+			raise ValueError("unsatisfiable range: %s" % header)
+		return max(size - length, 0), size
+
+	start = int(first)
+	if last:
+		end = int(last) + 1
+		if end <= start:
+			return None
+		end = min(end, size)
+	else:
+		end = size
+
+	if start >= size:
+		raise ValueError("unsatisfiable range: %s" % header)
+
+	return start, end
+
+# Serves the members of an archive over HTTP/1.1 with keep-alive and range
+# requests. Member data is sent with sendfile() directly from the archive to
+# the socket. At most max_connections connections are handled at once, further
+# connections wait in the listen backlog.
+def serve(archive,address=('127.0.0.1',8000),ext_func=lambda stream,offset,size:'',callback=lambda name: None,index=None,max_connections=SERVE_MAX_CONNECTIONS,ready=lambda server: None):
+	import socket
+	import threading
+	import mimetypes
+	import posixpath
+
+	if sys.version_info.major == 2:
+		from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+		from SocketServer import ThreadingMixIn
+		from urllib import unquote
+	else:
+		from http.server import BaseHTTPRequestHandler, HTTPServer
+		from socketserver import ThreadingMixIn
+		from urllib.parse import unquote as _unquote
+		# names are decoded as latin1, so this maps the URL back to the same bytes
+		unquote = lambda path: _unquote(path,encoding='latin1')
+
+	with PakArchive(archive,index) as pak:
+		stream = pak.stream
+		mtime  = os.fstat(stream.fileno()).st_mtime
+
+		# HTTP clients remove dot segments, so "./dir/file" is requested as "/dir/file"
+		def normalize(path):
+			return posixpath.normpath('/' + path).lstrip('/')
+
+		# doubled names: the last one wins
+		members = {}
+		for name, offset, size in pak.index:
+			members[normalize('/'.join(name.split(os.path.sep)) + ext_func(stream,offset,size))] = (offset, size)
+
+		if hasattr(os, 'sendfile'):
+			def send(out,offset,size,timeout):
+				sendfile(out,stream,offset,size,timeout)
+		elif pak.data is not None:
+			def send(out,offset,size,timeout):
+				end = offset + size
+				for pos in range(offset,end,COPY_CHUNK_SIZE):
+					out.write(mem_view(pak.data,pos,min(COPY_CHUNK_SIZE,end - pos)))
+		else:
+			# highlevel_sendfile() moves the shared file position
+			lock = threading.Lock()
+			def send(out,offset,size,timeout):
+				with lock:
+					highlevel_sendfile(out,stream,offset,size)
+
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+			server_version   = 'fezpak'
+			timeout  = SERVE_TIMEOUT
+			# Python 2 writes every header line on its own otherwise
+			wbufsize = -1
+
+			def setup(self):
+				BaseHTTPRequestHandler.setup(self)
+				# headers and member data are separate writes
+				self.connection.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+
+			def do_GET(self):
+				self.send_member(True)
+
+			def do_HEAD(self):
+				self.send_member(False)
+
+			def send_member(self,send_body):
+				name = normalize(unquote(self.path.split('?',1)[0]))
+				member = members.get(name)
+				if member is None:
+					self.send_error(404)
+					return
+
+				offset, size = member
+				try:
+					byte_range = parse_range(self.headers.get('Range'),size)
+				except ValueError:
+					self.send_response(416)
+					self.send_header('Content-Range','bytes */%d' % size)
+					self.send_header('Content-Length','0')
+					self.end_headers()
+					return
+
+				if byte_range is None:
+					start, end = 0, size
+					self.send_response(200)
+				else:
+					start, end = byte_range
+					self.send_response(206)
+					self.send_header('Content-Range','bytes %d-%d/%d' % (start, end - 1, size))
+
+				self.send_header('Content-Type',mimetypes.guess_type(name)[0] or 'application/octet-stream')
+				self.send_header('Content-Length',str(end - start))
+				self.send_header('Accept-Ranges','bytes')
+				self.send_header('Last-Modified',self.date_time_string(mtime))
+				self.end_headers()
+
+				if send_body:
+					callback(name)
+					# a stalled client must not hold its connection slot forever
+					send(self.wfile,offset + start,end - start,self.connection.gettimeout())
+
+			def log_message(self,format,*args):
+				pass
+
+		slots = threading.BoundedSemaphore(max_connections)
+
+		class Server(ThreadingMixIn, HTTPServer):
+			daemon_threads = True
+			allow_reuse_address = True
+
+			def process_request(self,request,client_address):
+				slots.acquire()
+				try:
+					ThreadingMixIn.process_request(self,request,client_address)
+				except:
+					slots.release()
+					raise
+
+			def process_request_thread(self,request,client_address):
+				try:
+					ThreadingMixIn.process_request_thread(self,request,client_address)
+				finally:
+					slots.release()
+
+			def handle_error(self,request,client_address):
+				# clients hang up all the time, e.g. when seeking in a media player
+				exc = sys.exc_info()[1]
+				if not isinstance(exc,socket.timeout) and getattr(exc,'errno',None) not in (errno.EPIPE, errno.ECONNRESET):
+					HTTPServer.handle_error(self,request,client_address)
+
+		server = Server(address,Handler)
+		try:
+			ready(server)
+			server.serve_forever()
+		finally:
+			server.server_close()
 
 def human_size(size):
 	if size < 2 ** 10:
@@ -289,31 +2442,65 @@ def human_size(size):
 	
 	return size+unit
 
-def print_list(stream,details=False,human=False,delim="\n",ext_func=lambda stream,offset,size:'',sort_func=None,out=sys.stdout):
-	index = read_index(stream)
+LIST_BATCH_SIZE = 4096
+
+def _write_batched(out,lines):
+	# one write per batch instead of one per line
+	while True:
+		batch = ''.join(islice(lines,LIST_BATCH_SIZE))
+		if not batch:
+			break
+		out.write(batch)
+
+def _csv_field(value):
+	if '"' in value or ',' in value or '\n' in value or '\r' in value:
+		return '"%s"' % value.replace('"','""')
+	return value
+
+def print_list(stream,details=False,human=False,delim="\n",ext_func=lambda stream,offset,size:'',sort=None,out=sys.stdout,index=None,fmt='text',limit=None):
+	if index is None:
+		index = load_index(stream)
+	else:
+		index = as_index(index)
+
+	if sort or limit is not None:
+		positions = sort_positions(index,sort or (),limit)
+	else:
+		positions = range(len(index))
+
+	names   = index.names
+	offsets = index.offsets
+	sizes   = index.sizes
 
-	if sort_func:
-		index = sorted(index,cmp=sort_func)
+	if fmt == 'json':
+		import json
+		out.write("[")
+		_write_batched(out,("%s\n{\"name\": %s, \"offset\": %u, \"size\": %u}" % (
+			"," if pos else "", json.dumps(names[i] + ext_func(stream,offsets[i],sizes[i])), offsets[i], sizes[i])
+			for pos, i in enumerate(positions)))
+		out.write("\n]\n")
 
-	if details:
+	elif fmt == 'csv':
+		out.write("name,offset,size\n")
+		_write_batched(out,("%s,%u,%u\n" % (_csv_field(names[i] + ext_func(stream,offsets[i],sizes[i])), offsets[i], sizes[i])
+			for i in positions))
+
+	elif fmt != 'text':
+		raise ValueError("unknown list format: %s" % fmt)
+
+	elif details:
 		if human:
 			size_to_str = human_size
 		else:
 			size_to_str = str
 
-		count = 0
-		sum_size = 0
 		out.write("    Offset       Size Name%s" % delim)
-		for name, offset, size in index:
-			ext = ext_func(stream,offset,size)
-			out.write("%10u %10s %s%s%s" % (offset, size_to_str(size), name, ext, delim))
-			count += 1
-			sum_size += size
-		out.write("%d file(s) (%s) %s" % (count, size_to_str(sum_size), delim))
+		_write_batched(out,("%10u %10s %s%s%s" % (offsets[i], size_to_str(sizes[i]), names[i], ext_func(stream,offsets[i],sizes[i]), delim)
+			for i in positions))
+		sum_size = sum(sizes[i] for i in positions)
+		out.write("%d file(s) (%s) %s" % (len(positions), size_to_str(sum_size), delim))
 	else:
-		for name, offset, size in index:
-			ext = ext_func(stream,offset,size)
-			out.write("%s%s%s" % (name, ext, delim))
+		_write_batched(out,("%s%s%s" % (names[i], ext_func(stream,offsets[i],sizes[i]), delim) for i in positions))
 
 SORT_ALIASES = {
 	"s": "size",
@@ -324,47 +2511,72 @@ SORT_ALIASES = {
 	"N": "-name"
 }
 
-# for Python 3
-if not hasattr(__builtins__,'cmp'):
-	def cmp(a, b):
-		return (a > b) - (a < b)
-
-CMP_FUNCS = {
-	"size":  lambda lhs, rhs: cmp(lhs[2], rhs[2]),
-	"-size": lambda lhs, rhs: cmp(rhs[2], lhs[2]),
-
-	"offset":  lambda lhs, rhs: cmp(lhs[1], rhs[1]),
-	"-offset": lambda lhs, rhs: cmp(rhs[1], lhs[1]),
-
-	"name":  lambda lhs, rhs: cmp(lhs[0], rhs[0]),
-	"-name": lambda lhs, rhs: cmp(rhs[0], lhs[0])
+# position of the key in an index entry
+SORT_COLUMNS = {
+	"name":   0,
+	"offset": 1,
+	"size":   2
 }
 
-def sort_func(sort):
-	cmp_funcs = []
+# Parses a comma separated list of sort keys into (column, descending) pairs.
+def sort_keys(sort):
+	keys = []
 	for key in sort.split(","):
 		key = SORT_ALIASES.get(key,key)
+		descending = key.startswith("-")
 		try:
-			func = CMP_FUNCS[key]
+			column = SORT_COLUMNS[key[1:] if descending else key]
 		except KeyError:
 			raise ValueError("unknown sort key: "+key)
-		cmp_funcs.append(func)
+		keys.append((column, descending))
+	return keys
+
+# Returns the positions of the entries of index sorted by keys. If limit is
+# given only the first limit positions are computed (with a heap, if the keys
+# allow it).
+def sort_positions(index,keys,limit=None):
+	import heapq
+
+	count = len(index)
+	if limit is not None:
+		limit = max(min(limit, count), 0)
+
+	if not keys:
+		return range(count if limit is None else limit)
+
+	if list(keys) == [(0, False)]:
+		# the name order might come from the index cache
+		order = index_order(index)
+		return order if limit is None else order[:limit]
+
+	columns = (index.names, index.offsets, index.sizes)
+	if limit is not None and limit < count:
+		cols = [columns[column] for column, descending in keys]
+		if len(set(descending for column, descending in keys)) == 1:
+			select = heapq.nlargest if keys[0][1] else heapq.nsmallest
+			if len(cols) == 1:
+				key = cols[0].__getitem__
+			else:
+				key = lambda i: tuple(col[i] for col in cols)
+			return select(limit,range(count),key=key)
+
+		elif all(column != 0 for column, descending in keys if descending):
+			# descending numbers can be negated, names can't
+			signs = [-1 if descending else 1 for column, descending in keys]
+			key = lambda i: tuple(sign * col[i] for sign, col in izip(signs, cols))
+			return heapq.nsmallest(limit,range(count),key=key)
 
-	def do_cmp(lhs,rhs):
-		for cmp_func in cmp_funcs:
-			i = cmp_func(lhs,rhs)
-			if i != 0:
-				return i
-		return 0
+	# stable sorts, least significant key first
+	positions = list(range(count))
+	for column, descending in reversed(keys):
+		positions.sort(key=columns[column].__getitem__,reverse=descending)
 
-	return do_cmp
+	return positions if limit is None else positions[:limit]
 
 if HAS_LLFUSE:
 	from collections import OrderedDict
-	import errno
 	import weakref
 	import stat
-	import mmap
 
 	class Entry(object):
 		__slots__ = 'inode','_parent','stat','__weakref__'
@@ -382,15 +2594,39 @@ if HAS_LLFUSE:
 		def parent(self,parent):
 			self._parent = weakref.ref(parent) if parent is not None else None
 
+	# Children of a directory by name. The names are also kept in an
+	# indexable list so readdir() can resume at a position in O(1).
+	class Children(dict):
+		__slots__ = 'names',
+
+		def __init__(self,children=()):
+			dict.__init__(self)
+			self.names = []
+			for name, child in children:
+				self[name] = child
+
+		def __setitem__(self,name,child):
+			if name not in self:
+				self.names.append(name)
+			dict.__setitem__(self,name,child)
+
+		def __iter__(self):
+			return iter(self.names)
+
+		def items(self):
+			return [(name, self[name]) for name in self.names]
+
 	class Dir(Entry):
-		__slots__ = 'children',
+		__slots__ = 'children','lazy_range'
 
 		def __init__(self,inode,children=None,parent=None):
 			Entry.__init__(self,inode,parent)
+			# (start, end, prefix length) of the not yet materialized children
+			self.lazy_range = None
 			if children is None:
-				self.children = OrderedDict()
+				self.children = Children()
 			else:
-				self.children = children
+				self.children = Children(children.items())
 				for child in children.values():
 					child.parent = self
 
@@ -411,55 +2647,197 @@ if HAS_LLFUSE:
 	DIR_SELF   = '.'.encode(sys.getfilesystemencoding())
 	DIR_PARENT = '..'.encode(sys.getfilesystemencoding())
 
+	ATTR_CACHE_SIZE = 4096
+
+	# the kernel caps these at what it supports
+	MOUNT_MAX_READ      = 2 ** 20
+	MOUNT_MAX_READAHEAD = 2 ** 20
+
+	# how much of a member is read ahead when it is opened
+	WILLNEED_SIZE = 2 ** 23
+
+	HAS_FADVISE = hasattr(os, 'posix_fadvise')
+	HAS_MADVISE = hasattr(mmap.mmap, 'madvise') and hasattr(mmap, 'MADV_WILLNEED')
+
+	# Tells the kernel that a member is about to be read front to back, so it
+	# starts reading its beginning into the page cache right away. The hint
+	# goes to whatever read() uses: the file with pread(), the mmap otherwise.
+	def advise_member(fd, data, offset, size):
+		if size == 0:
+			return
+
+		try:
+			if HAS_PREAD:
+				if HAS_FADVISE:
+					os.posix_fadvise(fd, offset, size, os.POSIX_FADV_SEQUENTIAL)
+					os.posix_fadvise(fd, offset, min(size, WILLNEED_SIZE), os.POSIX_FADV_WILLNEED)
+			elif HAS_MADVISE:
+				start = offset - offset % mmap.PAGESIZE
+				end   = offset + size
+				data.madvise(mmap.MADV_SEQUENTIAL, start, end - start)
+				data.madvise(mmap.MADV_WILLNEED, start, min(end, offset + WILLNEED_SIZE) - start)
+		except (OSError, ValueError):
+			# only a hint
+			pass
+
+	# Children of a directory are a contiguous range in the sorted names.
+	# Returns the sorted names and their positions in the index (None if
+	# the index already is sorted).
+	def sorted_names(index):
+		names = index.names
+		if index.order is None and all(names[i] <= names[i + 1] for i in range(len(names) - 1)):
+			return names, None
+		order = index_order(index)
+		return [names[i] for i in order], order
+
+	# Splits the range of sorted names belonging to a directory into its
+	# sub-directories (name, start, end, prefix length) and its files.
+	def group_children(keys, start, end, prefix_len):
+		sep = os.path.sep
+		after_sep = chr(ord(sep) + 1)
+		dirs  = []
+		files = []
+		pos = start
+		while pos < end:
+			key = keys[pos]
+			i = key.find(sep, prefix_len)
+			if i < 0:
+				files.append(pos)
+				pos += 1
+			else:
+				# skip over all entries in this sub-directory
+				dir_end = bisect_left(keys, key[:i] + after_sep, pos, end)
+				dirs.append((key[prefix_len:i], pos, dir_end, i + 1))
+				pos = dir_end
+		return dirs, files
+
+	def unique_name(taken, filename, name, ext, encoding):
+		enc_name = (name+ext).encode(encoding)
+
+		i = 0
+		while enc_name in taken:
+			sys.stderr.write("Warning: doubled name in archive: %s%s\n" % (filename, ext))
+			i += 1
+			enc_name = ("%s~%d%s" % (name, i, ext)).encode(encoding)
+
+		return enc_name
+
 	class Operations(llfuse.Operations):
-		__slots__ = 'archive','root','inodes','arch_st','data'
+		__slots__ = 'archive','fd','root','inodes','arch_st','data','ext_func','encoding','next_inode', \
+		            'lazy','index','keys','order','attr_cache'
 
-		def __init__(self, archive, ext_func=lambda data,offset,size:''):
-			llfuse.Operations.__init__(self)
-			self.archive = archive
-			self.arch_st = os.fstat(archive.fileno())
-			self.root    = Dir(llfuse.ROOT_INODE)
-			self.inodes  = {self.root.inode: self.root}
+		def __init__(self, archive, ext_func=lambda data,offset,size:'', index=None, lazy=False):
+			self._init_archive(archive, ext_func)
+			self.root     = Dir(llfuse.ROOT_INODE)
+			self.inodes   = {self.root.inode: self.root}
 			self.root.parent = self.root
+			self.lazy     = lazy
+			self.next_inode = self.root.inode + 1
+
+			if lazy:
+				self.index = as_index(index if index is not None else load_index(archive))
+				self.keys, self.order = sorted_names(self.index)
+				self.root.lazy_range = (0, len(self.keys), 0)
+			else:
+				self.index = self.keys = self.order = None
+				if index is None:
+					index = read_index(archive)
+
+				self._build_tree(index)
 
-			encoding = sys.getfilesystemencoding()
-			inode = self.root.inode + 1
-			for filename, offset, size in read_index(archive):
+			if not lazy:
+				self._cache_attrs()
+
+		def _build_tree(self, entries, add_file=None):
+			if add_file is None:
+				add_file = self._add_file
+
+			for filename, offset, size in entries:
 				path = filename.split(os.path.sep)
 				path, name = path[:-1], path[-1]
-				ext = ext_func(archive, offset, size)
-				enc_name = (name+ext).encode(encoding)
 
 				parent = self.root
 				for i, comp in enumerate(path):
-					comp = comp.encode(encoding)
+					comp = comp.encode(self.encoding)
 					try:
 						entry = parent.children[comp]
 					except KeyError:
-						entry = parent.children[comp] = self.inodes[inode] = Dir(inode, parent=parent)
-						inode += 1
-						
+						entry = parent.children[comp] = self._new_dir(parent)
+
 					if type(entry) is not Dir:
 						raise ValueError("name conflict in archive: %r is not a directory" % os.path.join(*path[:i+1]))
 
 					parent = entry
 
-				i = 0
-				while enc_name in parent.children:
-					sys.stderr.write("Warning: doubled name in archive: %s%s\n" % (filename, ext))
-					i += 1
-					enc_name = ("%s~%d%s" % (name, i, ext)).encode(encoding)
+				add_file(parent, filename, name, offset, size)
 
-				parent.children[enc_name] = self.inodes[inode] = File(inode, offset, size, parent)
-				inode += 1
+		def _cache_attrs(self):
+			for inode in self.inodes:
+				entry = self.inodes[inode]
+				entry.stat = self._getattr(entry)
+
+		def _init_archive(self, archive, ext_func):
+			llfuse.Operations.__init__(self)
+			self.archive  = archive
+			self.fd       = archive.fileno()
+			self.arch_st  = os.fstat(self.fd)
+			self.ext_func = ext_func
+			self.encoding = sys.getfilesystemencoding()
+			self.attr_cache = OrderedDict()
 
 			archive.seek(0, 0)
 			self.data = mmap.mmap(archive.fileno(), 0, access=mmap.ACCESS_READ)
 
-			# cache entry attributes
-			for inode in self.inodes:
-				entry = self.inodes[inode]
-				entry.stat = self._getattr(entry)
+		def _new_dir(self, parent):
+			entry = self.inodes[self.next_inode] = Dir(self.next_inode, parent=parent)
+			self.next_inode += 1
+			return entry
+
+		def _add_file(self, parent, filename, name, offset, size):
+			ext = self.ext_func(self.archive, offset, size)
+			enc_name = unique_name(parent.children, filename, name, ext, self.encoding)
+			entry = parent.children[enc_name] = self.inodes[self.next_inode] = File(self.next_inode, offset, size, parent)
+			self.next_inode += 1
+			return entry
+
+		def _children(self, entry):
+			if entry.lazy_range is not None:
+				self._materialize(entry)
+			return entry.children
+
+		def _materialize(self, entry):
+			start, end, prefix_len = entry.lazy_range
+			entry.lazy_range = None
+
+			keys  = self.keys
+			order = self.order
+			index = self.index
+
+			dirs, files = group_children(keys, start, end, prefix_len)
+			for comp, dir_start, dir_end, dir_prefix_len in dirs:
+				child = entry.children[comp.encode(self.encoding)] = self._new_dir(entry)
+				child.lazy_range = (dir_start, dir_end, dir_prefix_len)
+
+			# files are added after directories so that they get renamed on conflicts
+			for pos in files:
+				i = order[pos] if order is not None else pos
+				filename = keys[pos]
+				self._add_file(entry, filename, filename[prefix_len:], index.offsets[i], index.sizes[i])
+
+		def _stat(self, entry):
+			if entry.stat is not None:
+				return entry.stat
+			return self._cached_attrs(entry.inode, entry)
+
+		def _cached_attrs(self, inode, entry):
+			cache = self.attr_cache
+			attrs = cache.pop(inode, None)
+			if attrs is None:
+				attrs = self._getattr(entry)
+				if len(cache) >= ATTR_CACHE_SIZE:
+					cache.popitem(last=False)
+			cache[inode] = attrs
+			return attrs
 
 		def destroy(self):
 			self.data.close()
@@ -474,23 +2852,19 @@ if HAS_LLFUSE:
 					entry = self.inodes[parent_inode].parent
 
 				else:
-					entry = self.inodes[parent_inode].children[name]
+					entry = self._children(self.inodes[parent_inode])[name]
 
-			except KeyError:
+			except (KeyError, AttributeError):
 				raise llfuse.FUSEError(errno.ENOENT)
 			else:
-				return entry.stat
+				return self._stat(entry)
 
 		def _getattr(self, entry):
-			attrs = llfuse.EntryAttributes()
-
-			attrs.st_ino        = entry.inode
-			attrs.st_rdev       = 0
-			attrs.generation    = 0
-			attrs.entry_timeout = 300
-			attrs.attr_timeout  = 300
+			if type(entry) is Dir and self.lazy:
+				# counting sub-directories would materialize this directory
+				return self._make_attrs(entry.inode, stat.S_IFDIR | 0o555, 1, 0)
 
-			if type(entry) is Dir:
+			elif type(entry) is Dir:
 				nlink = 2 if entry is not self.root else 1
 				size  = 5
 
@@ -499,13 +2873,21 @@ if HAS_LLFUSE:
 					if type(child) is Dir:
 						nlink += 1
 
-				attrs.st_mode  = stat.S_IFDIR | 0o555
-				attrs.st_nlink = nlink
-				attrs.st_size  = size
+				return self._make_attrs(entry.inode, stat.S_IFDIR | 0o555, nlink, size)
 			else:
-				attrs.st_nlink = 1
-				attrs.st_mode  = stat.S_IFREG | 0o444
-				attrs.st_size  = entry.size
+				return self._make_attrs(entry.inode, stat.S_IFREG | 0o444, 1, entry.size)
+
+		def _make_attrs(self, inode, mode, nlink, size):
+			attrs = llfuse.EntryAttributes()
+
+			attrs.st_ino        = inode
+			attrs.st_rdev       = 0
+			attrs.generation    = 0
+			attrs.entry_timeout = 300
+			attrs.attr_timeout  = 300
+			attrs.st_mode       = mode
+			attrs.st_nlink      = nlink
+			attrs.st_size       = size
 
 			arch_st = self.arch_st
 			attrs.st_uid     = arch_st.st_uid
@@ -529,16 +2911,27 @@ if HAS_LLFUSE:
 			except KeyError:
 				raise llfuse.FUSEError(errno.ENOENT)
 			else:
-				return entry.stat
+				return self._stat(entry)
 
-		def access(self, inode, mode, ctx):
+		def _is_dir(self, inode):
 			try:
 				entry = self.inodes[inode]
 			except KeyError:
 				raise llfuse.FUSEError(errno.ENOENT)
 			else:
-				st_mode = 0o555 if type(entry) is Dir else 0o444
-				return (st_mode & mode) == mode
+				return type(entry) is Dir
+
+		def _file_range(self, inode):
+			try:
+				entry = self.inodes[inode]
+			except KeyError:
+				raise llfuse.FUSEError(errno.ENOENT)
+			else:
+				return entry.offset, entry.size
+
+		def access(self, inode, mode, ctx):
+			st_mode = 0o555 if self._is_dir(inode) else 0o444
+			return (st_mode & mode) == mode
 
 		def opendir(self, inode, ctx):
 			try:
@@ -549,6 +2942,7 @@ if HAS_LLFUSE:
 				if type(entry) is not Dir:
 					raise llfuse.FUSEError(errno.ENOTDIR)
 
+				self._children(entry)
 				return inode
 
 		def readdir(self, inode, offset):
@@ -560,10 +2954,12 @@ if HAS_LLFUSE:
 				if type(entry) is not Dir:
 					raise llfuse.FUSEError(errno.ENOTDIR)
 
-				names = list(entry.children)[offset:] if offset > 0 else entry.children
-				for name in names:
-					child = entry.children[name]
-					yield name, child.stat, child.inode
+				# the offset is the position after the last returned entry
+				children = self._children(entry)
+				names = children.names
+				for pos in range(offset, len(names)):
+					name = names[pos]
+					yield name, self._stat(children[name]), pos + 1
 
 		def releasedir(self, fh):
 			pass
@@ -585,18 +2981,122 @@ if HAS_LLFUSE:
 			return attrs
 
 		def open(self, inode, flags, ctx):
+			if self._is_dir(inode):
+				raise llfuse.FUSEError(errno.EISDIR)
+
+			if flags & 3 != os.O_RDONLY:
+				raise llfuse.FUSEError(errno.EACCES)
+
+			self._advise(inode)
+			return inode
+
+		def _advise(self, inode):
+			offset, size = self._file_range(inode)
+			advise_member(self.fd, self.data, offset, size)
+
+		def read(self, fh, offset, length):
+			file_offset, size = self._file_range(fh)
+
+			if offset > size:
+				return bytes()
+
+			i = file_offset + offset
+			count = min(size - offset, length)
+
+			# other requests can be served while this one waits for the disk
+			with llfuse.lock_released:
+				if HAS_PREAD:
+					# pread releases the GIL while copying
+					return os.pread(self.fd, count, i)
+				else:
+					return self.data[i:i + count]
+
+		def release(self, fh):
+			pass
+
+	class UnionFile(File):
+		__slots__ = 'archive',
+
+		def __init__(self,inode,archive,offset,size,parent=None):
+			File.__init__(self,inode,offset,size,parent)
+			self.archive = archive
+
+		def __repr__(self):
+			return 'UnionFile(%r, %r, %r, %r)' % (self.inode, self.archive, self.offset, self.size)
+
+	# Merges the indexes of several archives, later archives override members
+	# of earlier ones. Returns for every archive the entries that are visible.
+	def merge_indexes(indexes):
+		winners = {}
+		for k, index in enumerate(indexes):
+			for pos, name in enumerate(index.names):
+				winners[name] = (k, pos)
+
+		visible = []
+		for k, index in enumerate(indexes):
+			visible.append([(name, index.offsets[pos], index.sizes[pos])
+				for pos, name in enumerate(index.names) if winners[name] == (k, pos)])
+		return visible
+
+	# Overlays several archives in one file system. Every file knows the
+	# archive it comes from, so reads go directly to that archive.
+	class UnionOperations(Operations):
+		__slots__ = 'archives','fds','datas','ext_funcs'
+
+		def __init__(self, archives, ext_funcs=None, indexes=None):
+			if not archives:
+				raise ValueError("no archives given")
+
+			if ext_funcs is None:
+				ext_funcs = [lambda data,offset,size:''] * len(archives)
+			if indexes is None:
+				indexes = [None] * len(archives)
+
+			# the archive with the highest priority provides the file system attributes
+			self._init_archive(archives[-1], ext_funcs[-1])
+			self.archives  = list(archives)
+			self.ext_funcs = list(ext_funcs)
+			self.fds       = [archive.fileno() for archive in archives]
+			self.datas     = [self.data]
 			try:
-				entry = self.inodes[inode]
-			except KeyError:
-				raise llfuse.FUSEError(errno.ENOENT)
-			else:
-				if type(entry) is Dir:
-					raise llfuse.FUSEError(errno.EISDIR)
+				for archive in archives[:-1]:
+					archive.seek(0, 0)
+					self.datas.insert(-1, mmap.mmap(archive.fileno(), 0, access=mmap.ACCESS_READ))
+			except:
+				for data in self.datas:
+					data.close()
+				raise
+
+			self.root     = Dir(llfuse.ROOT_INODE)
+			self.inodes   = {self.root.inode: self.root}
+			self.root.parent = self.root
+			self.lazy     = False
+			self.index = self.keys = self.order = None
+			self.next_inode = self.root.inode + 1
 
-				if flags & 3 != os.O_RDONLY:
-					raise llfuse.FUSEError(errno.EACCES)
+			indexes = [as_index(index if index is not None else load_index(archive)) for archive, index in izip(archives, indexes)]
+			for k, entries in enumerate(merge_indexes(indexes)):
+				self._build_tree(entries, lambda parent, filename, name, offset, size, k=k:
+					self._add_union_file(k, parent, filename, name, offset, size))
 
-				return inode
+			self._cache_attrs()
+
+		def _add_union_file(self, k, parent, filename, name, offset, size):
+			ext = self.ext_funcs[k](self.archives[k], offset, size)
+			enc_name = unique_name(parent.children, filename, name, ext, self.encoding)
+			entry = parent.children[enc_name] = self.inodes[self.next_inode] = UnionFile(self.next_inode, k, offset, size, parent)
+			self.next_inode += 1
+			return entry
+
+		def destroy(self):
+			for data in self.datas:
+				data.close()
+			for archive in self.archives:
+				archive.close()
+
+		def _advise(self, inode):
+			entry = self.inodes[inode]
+			advise_member(self.fds[entry.archive], self.datas[entry.archive], entry.offset, entry.size)
 
 		def read(self, fh, offset, length):
 			try:
@@ -604,15 +3104,250 @@ if HAS_LLFUSE:
 			except KeyError:
 				raise llfuse.FUSEError(errno.ENOENT)
 
-			if offset > entry.size:
+			size = entry.size
+			if offset > size:
 				return bytes()
 
 			i = entry.offset + offset
-			j = i + min(entry.size - offset, length)
-			return self.data[i:j]
+			count = min(size - offset, length)
 
-		def release(self, fh):
-			pass
+			with llfuse.lock_released:
+				if HAS_PREAD:
+					return os.pread(self.fds[entry.archive], count, i)
+				else:
+					return self.datas[entry.archive][i:i + count]
+
+	INODE_TYPECODE = 'I'
+
+	# Flat inode table: the children of a directory get consecutive inodes
+	# sorted by name, so a directory only needs to know its first child and
+	# the number of children. Names of all entries are stored in one blob.
+	class InodeTable(object):
+		__slots__ = 'names','name_offsets','parents','kinds','offsets','sizes'
+
+		KIND_FILE = 0
+		KIND_DIR  = 1
+
+		def __init__(self):
+			self.names        = b''
+			self.name_offsets = array(OFFSET_TYPECODE, [0])
+			self.parents      = array(INODE_TYPECODE)
+			self.kinds        = bytearray()
+			# for directories: first child inode and number of children
+			self.offsets      = array(OFFSET_TYPECODE)
+			self.sizes        = array(OFFSET_TYPECODE)
+
+		@classmethod
+		def build(cls, index, ext_func, archive, encoding):
+			from collections import deque
+
+			table = cls()
+			keys, order = sorted_names(index)
+			root  = llfuse.ROOT_INODE
+			names = []
+
+			def append(parent, name, kind, offset, size):
+				names.append(name)
+				table.name_offsets.append(table.name_offsets[-1] + len(name))
+				table.parents.append(parent)
+				table.kinds.append(kind)
+				table.offsets.append(offset)
+				table.sizes.append(size)
+
+			append(root, b'', cls.KIND_DIR, 0, 0)
+			queue = deque([(root, 0, len(keys), 0)])
+			while queue:
+				inode, start, end, prefix_len = queue.popleft()
+				dirs, files = group_children(keys, start, end, prefix_len)
+
+				children = {}
+				for comp, dir_start, dir_end, dir_prefix_len in dirs:
+					children[comp.encode(encoding)] = (cls.KIND_DIR, dir_start, dir_end, dir_prefix_len)
+
+				for pos in files:
+					i = order[pos] if order is not None else pos
+					filename = keys[pos]
+					offset = index.offsets[i]
+					size   = index.sizes[i]
+					ext    = ext_func(archive, offset, size)
+					enc_name = unique_name(children, filename, filename[prefix_len:], ext, encoding)
+					children[enc_name] = (cls.KIND_FILE, offset, size)
+
+				k = inode - root
+				table.offsets[k] = root + len(table.kinds)
+				table.sizes[k]   = len(children)
+				for enc_name in sorted(children):
+					child = children[enc_name]
+					if child[0] == cls.KIND_DIR:
+						queue.append((root + len(table.kinds),) + child[1:])
+						append(inode, enc_name, cls.KIND_DIR, 0, 0)
+					else:
+						append(inode, enc_name, cls.KIND_FILE, child[1], child[2])
+
+			table.names = b''.join(names)
+			return table
+
+		def __len__(self):
+			return len(self.kinds)
+
+		def __contains__(self, inode):
+			return 0 <= inode - llfuse.ROOT_INODE < len(self.kinds)
+
+		def _pos(self, inode):
+			k = inode - llfuse.ROOT_INODE
+			if k < 0 or k >= len(self.kinds):
+				raise KeyError(inode)
+			return k
+
+		def name(self, inode):
+			k = inode - llfuse.ROOT_INODE
+			return self.names[self.name_offsets[k]:self.name_offsets[k + 1]]
+
+		def parent(self, inode):
+			return self.parents[self._pos(inode)]
+
+		def is_dir(self, inode):
+			return self.kinds[self._pos(inode)] == self.KIND_DIR
+
+		def file_range(self, inode):
+			k = self._pos(inode)
+			return self.offsets[k], self.sizes[k]
+
+		# Returns the range of child inodes of a directory.
+		def children(self, inode):
+			k = self._pos(inode)
+			first = self.offsets[k]
+			return first, first + self.sizes[k]
+
+		def lookup(self, parent, name):
+			lo, end = self.children(parent)
+			hi = end
+			while lo < hi:
+				mid = (lo + hi) // 2
+				if self.name(mid) < name:
+					lo = mid + 1
+				else:
+					hi = mid
+			if lo < end and self.name(lo) == name:
+				return lo
+			raise KeyError(name)
+
+		def dir_stat(self, inode):
+			first, end = self.children(inode)
+			root = llfuse.ROOT_INODE
+			subdirs = self.kinds[first - root:end - root].count(bytearray([self.KIND_DIR]))
+			nlink = subdirs + (2 if inode != root else 1)
+			size  = 5 + self.name_offsets[end - root] - self.name_offsets[first - root] + (end - first)
+			return nlink, size
+
+	class CompactOperations(Operations):
+		__slots__ = ()
+
+		def __init__(self, archive, ext_func=lambda data,offset,size:'', index=None):
+			self._init_archive(archive, ext_func)
+			if index is None:
+				index = load_index(archive)
+			self.inodes = InodeTable.build(as_index(index), ext_func, archive, self.encoding)
+
+		def _getattr(self, inode):
+			if self.inodes.is_dir(inode):
+				nlink, size = self.inodes.dir_stat(inode)
+				return self._make_attrs(inode, stat.S_IFDIR | 0o555, nlink, size)
+			else:
+				offset, size = self.inodes.file_range(inode)
+				return self._make_attrs(inode, stat.S_IFREG | 0o444, 1, size)
+
+		def _is_dir(self, inode):
+			try:
+				return self.inodes.is_dir(inode)
+			except KeyError:
+				raise llfuse.FUSEError(errno.ENOENT)
+
+		def _file_range(self, inode):
+			try:
+				return self.inodes.file_range(inode)
+			except KeyError:
+				raise llfuse.FUSEError(errno.ENOENT)
+
+		def lookup(self, parent_inode, name, ctx):
+			try:
+				if name == DIR_SELF:
+					if parent_inode not in self.inodes:
+						raise KeyError(parent_inode)
+					inode = parent_inode
+
+				elif name == DIR_PARENT:
+					inode = self.inodes.parent(parent_inode)
+
+				elif not self.inodes.is_dir(parent_inode):
+					raise KeyError(name)
+
+				else:
+					inode = self.inodes.lookup(parent_inode, name)
+
+			except KeyError:
+				raise llfuse.FUSEError(errno.ENOENT)
+			else:
+				return self._cached_attrs(inode, inode)
+
+		def getattr(self, inode, ctx):
+			if inode not in self.inodes:
+				raise llfuse.FUSEError(errno.ENOENT)
+			return self._cached_attrs(inode, inode)
+
+		def opendir(self, inode, ctx):
+			if not self._is_dir(inode):
+				raise llfuse.FUSEError(errno.ENOTDIR)
+			return inode
+
+		def readdir(self, inode, offset):
+			if not self._is_dir(inode):
+				raise llfuse.FUSEError(errno.ENOTDIR)
+
+			first, end = self.inodes.children(inode)
+			for child in range(first + offset, end):
+				yield self.inodes.name(child), self._cached_attrs(child, child), child - first + 1
+
+	FUSE_METHODS = ('lookup', 'getattr', 'access', 'opendir', 'readdir', 'releasedir',
+	                'statfs', 'open', 'read', 'release')
+
+	def _timed_method(name, method):
+		phase = 'fuse.' + name
+
+		if name == 'readdir':
+			# llfuse stops iterating when its buffer is full
+			def timed(self, *args):
+				stats = STATS
+				start = clock()
+				try:
+					for item in method(self, *args):
+						yield item
+				finally:
+					if stats is not None:
+						stats.add_time(phase, clock() - start)
+
+		elif name == 'read':
+			def timed(self, *args):
+				with stats_phase(phase):
+					data = method(self, *args)
+				stats_count('bytes.fuse_read', len(data))
+				return data
+
+		else:
+			def timed(self, *args):
+				with stats_phase(phase):
+					return method(self, *args)
+
+		timed.__name__ = name
+		return timed
+
+	# Returns a subclass of cls that records the time spent in the file system
+	# operations. It is only used when the stats are enabled, so the normal
+	# classes don't pay for it.
+	def instrumented_operations(cls):
+		methods = dict((name, _timed_method(name, getattr(cls, name))) for name in FUSE_METHODS)
+		methods['__slots__'] = ()
+		return type('Instrumented' + cls.__name__, (cls,), methods)
 
 	# based on http://code.activestate.com/recipes/66012/
 	def deamonize(stdout='/dev/null', stderr=None, stdin='/dev/null'):
@@ -659,25 +3394,75 @@ if HAS_LLFUSE:
 		os.dup2(so.fileno(), sys.stdout.fileno())
 		os.dup2(se.fileno(), sys.stderr.fileno())
 
-	def mount(archive,mountpt,ext_func=lambda data,offset,size:'',foreground=False,debug=False):
+	def mount(archive,mountpt,ext_func=lambda data,offset,size:'',foreground=False,debug=False,index=None,workers=None,lazy=False,compact=False,
+	          max_read=MOUNT_MAX_READ,max_readahead=MOUNT_MAX_READAHEAD):
 		archive = os.path.abspath(archive)
 		mountpt = os.path.abspath(mountpt)
 		with open(archive,"rb") as fp:
-			ops = Operations(fp,ext_func)
-			args = ['fsname=fezpak', 'subtype=fezpak', 'ro']
+			if compact:
+				ops_class = CompactOperations
+			else:
+				ops_class = Operations
 
-			if debug:
-				foreground = True
-				args.append('debug')
+			if STATS is not None:
+				ops_class = instrumented_operations(ops_class)
 
-			if not foreground:
-				deamonize()
+			with stats_phase('mount.build_tree'):
+				if compact:
+					ops = ops_class(fp,ext_func,index)
+				else:
+					ops = ops_class(fp,ext_func,index,lazy)
 
-			llfuse.init(ops, mountpt, args)
-			try:
+			_run_fuse(ops,mountpt,foreground,debug,workers,max_read,max_readahead)
+
+	# Mounts several archives as one file system. Members of later archives
+	# override members of the same name in earlier ones.
+	def union_mount(archives,mountpt,ext_funcs=None,foreground=False,debug=False,indexes=None,workers=None,
+	                max_read=MOUNT_MAX_READ,max_readahead=MOUNT_MAX_READAHEAD):
+		archives = [os.path.abspath(archive) for archive in archives]
+		mountpt = os.path.abspath(mountpt)
+		fps = []
+		try:
+			for archive in archives:
+				fps.append(open(archive,"rb"))
+
+			ops_class = UnionOperations
+			if STATS is not None:
+				ops_class = instrumented_operations(ops_class)
+
+			with stats_phase('mount.build_tree'):
+				ops = ops_class(fps,ext_funcs,indexes)
+
+			_run_fuse(ops,mountpt,foreground,debug,workers,max_read,max_readahead)
+		finally:
+			for fp in fps:
+				fp.close()
+
+	# llfuse replies to every open with keep_cache, and the archive doesn't
+	# change while it is mounted, so cached pages survive between opens.
+	def _run_fuse(ops,mountpt,foreground,debug,workers,max_read=MOUNT_MAX_READ,max_readahead=MOUNT_MAX_READAHEAD):
+		args = ['fsname=fezpak', 'subtype=fezpak', 'ro',
+		        'max_read=%d' % max_read, 'max_readahead=%d' % max_readahead]
+
+		if debug:
+			foreground = True
+			args.append('debug')
+
+		if not foreground:
+			deamonize()
+
+		llfuse.init(ops, mountpt, args)
+		try:
+			if workers is None:
 				llfuse.main()
-			finally:
-				llfuse.close()
+			else:
+				try:
+					llfuse.main(workers=workers)
+				except TypeError:
+					# llfuse < 0.42
+					llfuse.main(single=workers == 1)
+		finally:
+			llfuse.close()
 
 def main(argv):
 	import argparse
@@ -716,7 +3501,7 @@ def main(argv):
 
 	parser = argparse.ArgumentParser(description='pack, unpack, list and mount FEZ .pak archives')
 	parser.register('action', 'parsers', AliasedSubParsersAction)
-	parser.set_defaults(print0=False,verbose=False,extension='',guess_extension=False)
+	parser.set_defaults(print0=False,verbose=False,extension='',guess_extension=False,no_cache=False,rebuild_cache=False,stats=False)
 
 	subparsers = parser.add_subparsers(metavar='command')
 
@@ -724,37 +3509,149 @@ def main(argv):
 	pack_parser.set_defaults(command='pack')
 	pack_parser.add_argument('-X','--remove-extension',dest='remove_ext',action='store_true',default=False,
 		help='remove file name extensions')
+	pack_parser.add_argument('-j','--jobs',type=int,default=1,metavar='N',
+		help='pack files using N threads')
 	add_common_args(pack_parser)
 	pack_parser.add_argument('files', metavar='file', nargs='*', help='files and directories to pack')
 
+	export_parser = subparsers.add_parser('export',aliases=('e',),help="convert archive to tar or zip")
+	export_parser.set_defaults(command='export')
+	add_ext_arg(export_parser)
+	add_cache_args(export_parser)
+	export_parser.add_argument('-f','--format',choices=('tar','zip'),default=None,
+		help='output format (default: zip if OUTPUT ends in .zip, tar otherwise)')
+	add_common_args(export_parser)
+	export_parser.add_argument('output', help='tar or zip file to write, - for stdout')
+
+	import_parser = subparsers.add_parser('import',aliases=('i',),help="create archive from tar or zip")
+	import_parser.set_defaults(command='import')
+	import_parser.add_argument('-X','--remove-extension',dest='remove_ext',action='store_true',default=False,
+		help='remove file name extensions')
+	import_parser.add_argument('-f','--format',choices=('tar','zip'),default=None,
+		help='input format (default: zip if INPUT ends in .zip, tar otherwise). '
+		     'Compressed tar files are supported.')
+	add_common_args(import_parser)
+	import_parser.add_argument('input', help='tar or zip file to read, - for stdin')
+
+	serve_parser = subparsers.add_parser('serve',aliases=('s',),help="serve archive members over HTTP")
+	serve_parser.set_defaults(command='serve')
+	add_ext_arg(serve_parser)
+	add_cache_args(serve_parser)
+	serve_parser.add_argument('-b','--bind',type=str,default='127.0.0.1',metavar='ADDRESS',
+		help='address to listen on (default: 127.0.0.1)')
+	serve_parser.add_argument('-p','--port',type=int,default=8000,
+		help='port to listen on (default: 8000)')
+	serve_parser.add_argument('-c','--max-connections',type=int,default=SERVE_MAX_CONNECTIONS,metavar='N',
+		help='maximum number of concurrent connections (default: %d)' % SERVE_MAX_CONNECTIONS)
+	add_common_args(serve_parser)
+
+	update_parser = subparsers.add_parser('update',aliases=('u',),help="add, replace or delete archive members in place")
+	update_parser.set_defaults(command='update')
+	update_parser.add_argument('-X','--remove-extension',dest='remove_ext',action='store_true',default=False,
+		help='remove file name extensions')
+	update_parser.add_argument('-d','--delete',action='append',default=[],metavar='NAME',
+		help='delete files and directories from the archive (can be given multiple times)')
+	add_common_args(update_parser)
+	update_parser.add_argument('files', metavar='file', nargs='*', help='files and directories to add or replace')
+
 	unpack_parser = subparsers.add_parser('unpack',aliases=('x',),help='unpack archive')
 	unpack_parser.set_defaults(command='unpack')
 	add_ext_arg(unpack_parser)
+	add_cache_args(unpack_parser)
 	unpack_parser.add_argument('-C','--dir',type=str,default='.',
 		help='directory to write unpacked files')
+	unpack_parser.add_argument('-j','--jobs',type=int,default=1,metavar='N',
+		help='unpack files using N threads')
+	dedup_group = unpack_parser.add_mutually_exclusive_group()
+	dedup_group.add_argument('--dedup',action='store_const',const='hardlink',default=None,
+		help='hardlink files with identical content instead of writing them again')
+	dedup_group.add_argument('--reflink',dest='dedup',action='store_const',const='reflink',
+		help='reflink files with identical content (falls back to copying)')
 	add_common_args(unpack_parser)
 	unpack_parser.add_argument('files', metavar='file', nargs='*', help='files and directories to unpack')
 
+	cat_parser = subparsers.add_parser('cat',aliases=('p',),help='write archive members to stdout')
+	cat_parser.set_defaults(command='cat')
+	add_cache_args(cat_parser)
+	cat_parser.add_argument('-E','--regex',action='store_true',default=False,
+		help='patterns are regular expressions instead of glob patterns')
+	add_common_args(cat_parser)
+	cat_parser.add_argument('patterns', metavar='pattern', nargs='+', help='names of the members to write (glob patterns)')
+
+	verify_parser = subparsers.add_parser('verify',aliases=('t',),help='check archive integrity')
+	verify_parser.set_defaults(command='verify')
+	verify_parser.add_argument('-j','--jobs',type=int,default=1,metavar='N',
+		help='hash members using N threads')
+	verify_parser.add_argument('--fast',action='store_true',default=False,
+		help='only check the archive structure (entry count, bounds, trailing bytes), don\'t read member data')
+	verify_parser.add_argument('--hash',default='sha256',metavar='NAME',
+		help='hash algorithm for --write-manifest (default: sha256)')
+	manifest_group = verify_parser.add_mutually_exclusive_group()
+	manifest_group.add_argument('-m','--manifest',default=None,metavar='FILE',
+		help='compare the archive to a manifest')
+	manifest_group.add_argument('-w','--write-manifest',default=None,metavar='FILE',
+		help='write name, offset, size and digest of all members to FILE (- for stdout)')
+	add_common_args(verify_parser)
+
+	diff_parser = subparsers.add_parser('diff',help='list members that differ between two archives')
+	diff_parser.set_defaults(command='diff')
+	diff_parser.add_argument('-j','--jobs',type=int,default=1,metavar='N',
+		help='hash members using N threads')
+	diff_parser.add_argument('-o','--patch',default=None,metavar='FILE',
+		help='write a patch that turns OLD into NEW to FILE')
+	add_stats_arg(diff_parser)
+	diff_parser.add_argument('old', help='old FEZ .pak archive')
+	diff_parser.add_argument('new', help='new FEZ .pak archive')
+
+	patch_parser = subparsers.add_parser('patch',help='apply a patch written by diff')
+	patch_parser.set_defaults(command='patch')
+	add_stats_arg(patch_parser)
+	patch_parser.add_argument('old', help='old FEZ .pak archive')
+	patch_parser.add_argument('patch', help='patch file')
+	patch_parser.add_argument('new', help='FEZ .pak archive to write')
+
 	list_parser = subparsers.add_parser('list',aliases=('l',),help='list archive contens')
 	list_parser.set_defaults(command='list')
 	list_parser.add_argument('-u','--human-readable',dest='human',action='store_true',default=False,
 		help='print human readable file sizes')
 	list_parser.add_argument('-d','--details',action='store_true',default=False,
 		help='print file offsets and sizes')
-	list_parser.add_argument('-s','--sort',dest='sort_func',metavar='KEYS',type=sort_func,default=None,
+	list_parser.add_argument('-s','--sort',metavar='KEYS',type=sort_keys,default=None,
 		help='sort file list. Comma seperated list of sort keys. Keys are "size", "offset", and "name". '
 		     'Prepend "-" to a key name to sort in descending order.')
+	list_parser.add_argument('-n','--limit',type=int,default=None,metavar='N',
+		help='only list the first N files (after sorting), e.g. -s=-size -n 20 for the 20 biggest files')
+	format_group = list_parser.add_mutually_exclusive_group()
+	format_group.add_argument('--json',dest='format',action='store_const',const='json',default='text',
+		help='print name, offset and size of all files as JSON')
+	format_group.add_argument('--csv',dest='format',action='store_const',const='csv',
+		help='print name, offset and size of all files as CSV')
 	add_ext_arg(list_parser)
+	add_cache_args(list_parser)
 	add_common_args(list_parser)
 
 	mount_parser = subparsers.add_parser('mount',aliases=('m',),help='fuse mount archive')
 	mount_parser.set_defaults(command='mount')
 	add_ext_arg(mount_parser)
+	add_cache_args(mount_parser)
 	mount_parser.add_argument('-d','--debug',action='store_true',default=False,
 		help='print debug output (implies -f)')
 	mount_parser.add_argument('-f','--foreground',action='store_true',default=False,
 		help='foreground operation')
-	mount_parser.add_argument('archive', help='FEZ .pak archive')
+	mount_parser.add_argument('-j','--workers',type=int,default=None,metavar='N',
+		help='number of worker threads handling file system requests')
+	mount_parser.add_argument('--max-read',type=int,default=1048576,metavar='BYTES',
+		help='maximum size of a read request (default: 1048576, the kernel might use less)')
+	mount_parser.add_argument('--max-readahead',type=int,default=1048576,metavar='BYTES',
+		help='maximum kernel readahead (default: 1048576, the kernel might use less)')
+	tree_group = mount_parser.add_mutually_exclusive_group()
+	tree_group.add_argument('-l','--lazy',action='store_true',default=False,
+		help='build directories and file attributes on first access (faster mount of big archives)')
+	tree_group.add_argument('--compact',action='store_true',default=False,
+		help='use a compact array based inode table (less memory for big archives)')
+	add_stats_arg(mount_parser)
+	mount_parser.add_argument('archives', metavar='archive', nargs='+',
+		help='FEZ .pak archive(s). Members of later archives override members of earlier ones.')
 	mount_parser.add_argument('mountpt', help='mount point')
 
 	args = parser.parse_args(argv)
@@ -772,36 +3669,177 @@ def main(argv):
 		ext = args.extension
 		ext_func = lambda stream, offset, size: ext
 
-	if args.command == 'list':
-		with open(args.archive,"rb") as stream:
-			print_list(stream,args.details,args.human,delim,ext_func,args.sort_func)
+	def get_index(stream):
+		if not args.no_cache:
+			return cached_index(stream,guess_extension=args.guess_extension,rebuild=args.rebuild_cache)
+
+		elif args.guess_extension:
+			index = load_index(stream)
+			index.exts = guess_extensions(stream,index)
+			return index
+
+		else:
+			return None
+
+	def get_ext_func(index):
+		if index is not None and index.exts is not None and args.guess_extension:
+			return index_ext_func(index)
+		return ext_func
+
+	if args.stats:
+		enable_stats()
+
+	try:
+		if args.command == 'list':
+			with open(args.archive,"rb") as stream:
+				index = get_index(stream)
+				print_list(stream,args.details,args.human,delim,get_ext_func(index),args.sort,index=index,fmt=args.format,limit=args.limit)
 	
-	elif args.command == 'unpack':
-		with open(args.archive,"rb") as stream:
-			if args.files:
-				unpack_files(stream,set(name.strip(os.path.sep) for name in args.files),args.dir,ext_func,callback)
+		elif args.command == 'unpack':
+			with open(args.archive,"rb") as stream:
+				index = get_index(stream)
+				if args.files:
+					saved = unpack_files(stream,set(name.strip(os.path.sep) for name in args.files),args.dir,get_ext_func(index),callback,index,args.jobs,args.dedup)
+				else:
+					saved = unpack(stream,args.dir,get_ext_func(index),callback,index,args.jobs,args.dedup)
+
+			if args.dedup:
+				sys.stderr.write("deduplication saved %s byte(s)\n" % human_size(saved))
+
+		elif args.command == 'cat':
+			if args.verbose:
+				# stdout is taken by the member data
+				callback = lambda name: sys.stderr.write("%s%s" % (name, delim))
+			with open(args.archive,"rb") as stream:
+				index = get_index(stream)
+				try:
+					count = cat_members(stream,getattr(sys.stdout,'buffer',sys.stdout),args.patterns,args.regex,callback,index)
+				except (IOError, OSError) as exc:
+					# the reader went away, e.g. "fezpak.py cat ... | head"
+					if exc.errno != errno.EPIPE:
+						raise
+					count = None
+
+			if count == 0:
+				raise ValueError("no member matches the given pattern(s)")
+
+		elif args.command == 'pack':
+			with open(args.archive,"wb") as stream:
+				pack_files(stream,args.files or ['.'],args.remove_ext,callback,args.jobs)
+
+		elif args.command == 'export':
+			fmt = args.format or archive_format(args.output)
+			with open(args.archive,"rb") as stream:
+				index = get_index(stream)
+				if args.output == '-':
+					if args.verbose:
+						# stdout is taken by the exported archive
+						callback = lambda name: sys.stderr.write("%s%s" % (name, delim))
+					export_archive(stream,getattr(sys.stdout,'buffer',sys.stdout),fmt,get_ext_func(index),callback,index)
+				else:
+					with open(args.output,"wb") as out:
+						export_archive(stream,out,fmt,get_ext_func(index),callback,index)
+
+		elif args.command == 'import':
+			fmt = args.format or archive_format(args.input)
+			# readable, so hard links can copy the data of their target
+			with open(args.archive,"w+b") as stream:
+				if args.input == '-':
+					import_archive(getattr(sys.stdin,'buffer',sys.stdin),stream,fmt,args.remove_ext,callback)
+				else:
+					with open(args.input,"rb") as infile:
+						import_archive(infile,stream,fmt,args.remove_ext,callback)
+
+		elif args.command == 'serve':
+			def ready(server):
+				host, port = server.server_address[:2]
+				sys.stderr.write("serving %s on http://%s:%d/\n" % (args.archive, host, port))
+
+			with open(args.archive,"rb") as stream:
+				index = get_index(stream)
+				try:
+					serve(stream,(args.bind,args.port),get_ext_func(index),callback,index,args.max_connections,ready)
+				except KeyboardInterrupt:
+					pass
+
+		elif args.command == 'update':
+			with open(args.archive,"r+b") as stream:
+				update(stream,args.files,set(name.strip(os.path.sep) for name in args.delete),args.remove_ext,callback)
+
+		elif args.command == 'verify':
+			if args.fast and args.write_manifest is not None:
+				raise ValueError('a manifest can\'t be written in fast mode')
+
+			manifest = None
+			if args.manifest is not None:
+				with io.open(args.manifest,"r",encoding="utf-8") as fp:
+					manifest = read_manifest(fp)
+
+			if args.verbose and args.write_manifest == '-':
+				# stdout is taken by the manifest
+				callback = lambda name: sys.stderr.write("%s%s" % (name, delim))
+
+			with open(args.archive,"rb") as stream:
+				index, digests, problems = verify(stream,manifest,args.hash,args.jobs,args.fast,callback)
+
+			if args.write_manifest == '-':
+				write_manifest(sys.stdout,index,digests,args.hash)
+			elif args.write_manifest is not None:
+				with io.open(args.write_manifest,"w",encoding="utf-8") as fp:
+					write_manifest(fp,index,digests,args.hash)
+
+			for name, problem in problems:
+				sys.stdout.write("%s: %s\n" % (name, problem))
+
+			if problems:
+				raise ValueError("%d problem(s) found" % len(problems))
+
+		elif args.command == 'diff':
+			with open(args.old,"rb") as old_stream, open(args.new,"rb") as new_stream:
+				old_index = load_index(old_stream)
+				new_index = load_index(new_stream)
+				for status, name in diff_archives(old_stream,new_stream,args.jobs,old_index,new_index):
+					sys.stdout.write("%s %s\n" % (status, name))
+
+				if args.patch is not None:
+					with open(args.patch,"wb") as out:
+						copied, stored = write_patch(old_stream,new_stream,out,args.jobs,old_index,new_index)
+					sys.stderr.write("patch copies %s byte(s) and stores %s byte(s)\n" % (human_size(copied), human_size(stored)))
+
+		elif args.command == 'patch':
+			with open(args.old,"rb") as old_stream, open(args.patch,"rb") as patch, open(args.new,"wb") as out:
+				apply_patch(old_stream,patch,out)
+
+		elif args.command == 'mount':
+			if not HAS_LLFUSE:
+				raise ValueError('the llfuse python module is needed for this feature')
+
+			indexes = []
+			for archive in args.archives:
+				with open(archive,"rb") as stream:
+					indexes.append(get_index(stream))
+
+			# the stats are printed when the file system is unmounted
+			foreground = args.foreground or args.stats
+			if len(args.archives) == 1:
+				mount(args.archives[0],args.mountpt,get_ext_func(indexes[0]),foreground,args.debug,indexes[0],args.workers,args.lazy,args.compact,
+				      args.max_read,args.max_readahead)
 			else:
-				unpack(stream,args.dir,ext_func,callback)
-	
-	elif args.command == 'pack':
-		with open(args.archive,"wb") as stream:
-			pack_files(stream,args.files or ['.'],args.remove_ext,callback)
-
-	elif args.command == 'mount':
-		if not HAS_LLFUSE:
-			raise ValueError('the llfuse python module is needed for this feature')
+				if args.lazy or args.compact:
+					raise ValueError('--lazy and --compact are not supported when mounting several archives')
 
-		mount(args.archive,args.mountpt,ext_func,args.foreground,args.debug)
+				ext_funcs = [get_ext_func(index) for index in indexes]
+				union_mount(args.archives,args.mountpt,ext_funcs,foreground,args.debug,indexes,args.workers,
+				            args.max_read,args.max_readahead)
 
-	else:
-		raise ValueError('unknown command: %s' % args.command)
+		else:
+			raise ValueError('unknown command: %s' % args.command)
+	finally:
+		stats = disable_stats()
+		if stats is not None:
+			stats.report(sys.stderr)
 
-def ext_from_data(data):
-	for ext, matchers in FILE_TYPES:
-		for matches in matchers:
-			if matches(data):
-				return ext
-	return '.bin'
+ext_from_data = compile_file_types(FILE_TYPES)
 
 def ext_from_file(stream,offset,size):
 	stream.seek(offset, 0)
@@ -812,12 +3850,35 @@ def ext_from_mmap(mem,offset,size):
 	data = mem[offset:offset+min(MAX_MAGIC_SIZE,size)]
 	return ext_from_data(data)
 
+# Guesses the file name extensions of all entries in one go.
+def guess_extensions(stream,index):
+	mem = _map_archive(stream)
+	if mem is None:
+		return [ext_from_file(stream,offset,size) for name, offset, size in index]
+
+	try:
+		return [ext_from_mmap(mem,offset,size) for name, offset, size in index]
+	finally:
+		mem.close()
+
 def add_common_args(parser):
 	parser.add_argument('archive', help='FEZ .pak archive')
 	parser.add_argument('-0','--print0',action='store_true',default=False,
 		help='seperate file names with nil bytes')
 	parser.add_argument('-v','--verbose',action='store_true',default=False,
 		help='print verbose output')
+	add_stats_arg(parser)
+
+def add_stats_arg(parser):
+	parser.add_argument('--stats',action='store_true',default=False,
+		help='print timings of the phases and I/O counters to stderr when done')
+
+def add_cache_args(parser):
+	group = parser.add_mutually_exclusive_group()
+	group.add_argument('--no-cache',action='store_true',default=False,
+		help='don\'t use the on-disk index cache')
+	group.add_argument('--rebuild-cache',action='store_true',default=False,
+		help='rebuild the on-disk index cache')
 
 def add_ext_arg(parser):
 	group = parser.add_mutually_exclusive_group()